@@ -1,31 +1,35 @@
 import cv2
+import framestore
 import os
 from datetime import datetime
 from detect import VMath
 from pipeline import Pipeline, FRAME_WIDTH, FRAME_HEIGHT
+from profiling import PROFILER
 from record import NUM_FRAMES
 
 def main(**kwargs):
     # Create pipeline from command line arguments
     pipeline = Pipeline.create(**kwargs)
 
-    directory = "data/" + str(pipeline.__class__)
+    directory = "data/" + pipeline.name
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    prev = None
-    current = None
+    # Frames of the recording, raw if it has a frame store
+    frames = list(framestore.load("data/analysis"))
+    if len(frames) < 2:
+        print "not enough frames in data/analysis, run record.py first"
+        return
 
     overall = (0, 0)
     hand_size = (0, 0)
     time_start = datetime.now()
     time_now = datetime.now()
     
-    for i in range(0, NUM_FRAMES):
+    current = frames[0]
+    for i in range(1, min(NUM_FRAMES, len(frames))):
         prev = current
-        current = cv2.imread("data/analysis/img%04d.jpg" % i)
-        if prev is None:
-            continue
+        current = frames[i]
 
         # Detect hand and direction of the scene
         largest, direction, frame_out = pipeline.detect(prev, current)
@@ -43,6 +47,9 @@ def main(**kwargs):
     print("frames/sec: " + str(1e6 * (1. * i) / (time_diff.seconds * 1e6 + time_diff.microseconds)))
     print("average direction (x, y): " + str(VMath.scale(overall, 1.0 / (NUM_FRAMES - 1))))
     print("average hand size (width, height): " + str(VMath.scale(hand_size, 1.0 / (NUM_FRAMES - 1))))
+    if PROFILER.enabled:
+        print(PROFILER.report())
+    print("stage counters: " + str(pipeline.stats()))
 
 
 if __name__ == "__main__":
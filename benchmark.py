@@ -0,0 +1,99 @@
+import framestore
+import json
+import multiprocessing
+import numpy as np
+import time
+import traceback
+from pipeline import Pipeline, PIPELINE_TYPES
+from profiling import PROFILER
+
+# Pipelines that open windows, which cannot be benchmarked
+INTERACTIVE_TYPES = ["screenshot"]
+
+# Latency percentiles to report
+PERCENTILES = [50, 90, 99]
+
+def benchmark(pipeline_type, directory, kwargs):
+    """
+    Runs one type of pipeline over the frames in directory. Frames come from
+    the raw frame store if the recording has one, or are decoded, and are
+    read into memory before the clock starts, so the report separates the
+    I/O time from the time spent in detect.
+    """
+    try:
+        time_start = time.time()
+        # Frame store frames are lazy views of the file, so copy them to
+        # page them in now rather than in the first detect on each frame
+        frames = [np.array(frame) for frame in framestore.load(directory)]
+        load_time = time.time() - time_start
+        if len(frames) < 2:
+            raise Exception("not enough frames in " + directory)
+
+        pipeline = Pipeline.create(pipeline_type, **kwargs)
+        PROFILER.reset()
+        latencies = []
+        for prev, current in zip(frames, frames[1:]):
+            time_start = time.time()
+            pipeline.detect(prev, current)
+            latencies.append(time.time() - time_start)
+        latencies = np.array(latencies) * 1000
+
+        report = {
+            "frames": len(latencies),
+            "load_sec": load_time,
+            "detect_sec": latencies.sum() / 1000,
+            "fps": len(latencies) / (latencies.sum() / 1000),
+            "mean_ms": latencies.mean(),
+            "max_ms": latencies.max(),
+        }
+        for p in PERCENTILES:
+            report["p%d_ms" % p] = np.percentile(latencies, p)
+        if PROFILER.enabled:
+            report["stages"] = PROFILER.summary()
+        report["counters"] = pipeline.stats()
+        return pipeline_type, report
+    except Exception:
+        return pipeline_type, {"error": traceback.format_exc()}
+
+def _benchmark(args):
+    return benchmark(*args)
+
+def main(types, directory, output, processes, **kwargs):
+    kwargs.pop("pipeline_type", None)
+    pool = multiprocessing.Pool(processes)
+    results = pool.map(_benchmark, [(pipeline_type, directory, kwargs)
+                                    for pipeline_type in types])
+    pool.close()
+
+    report = {"dataset": directory, "pipelines": dict(results)}
+    print "%-12s %8s %8s %8s %8s %8s %8s" % ("pipeline", "fps", "mean_ms",
+                                            "p50_ms", "p90_ms", "p99_ms", "load_s")
+    for pipeline_type, result in results:
+        if "error" in result:
+            print "%-12s failed:\n%s" % (pipeline_type, result["error"])
+            continue
+        print "%-12s %8.1f %8.2f %8.2f %8.2f %8.2f %8.2f" % (
+            pipeline_type, result["fps"], result["mean_ms"], result["p50_ms"],
+            result["p90_ms"], result["p99_ms"], result["load_sec"])
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    Pipeline.parser.add_argument("--types", type=str, nargs="+",
+                                 choices=PIPELINE_TYPES, dest="types",
+                                 default=[t for t in PIPELINE_TYPES
+                                          if t not in INTERACTIVE_TYPES],
+                                 help="types of pipelines to benchmark")
+    Pipeline.parser.add_argument("--data", type=str, default="data/analysis",
+                                 dest="directory",
+                                 help="directory of recorded frames")
+    Pipeline.parser.add_argument("--output", type=str, dest="output",
+                                 help="file to write the json report to")
+    Pipeline.parser.add_argument("--processes", type=int,
+                                 default=multiprocessing.cpu_count(),
+                                 dest="processes",
+                                 help="number of pipelines to run at once")
+    args = Pipeline.parser.parse_args()
+    main(**vars(args))
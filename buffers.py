@@ -0,0 +1,55 @@
+import numpy as np
+import threading
+
+class BufferPool(object):
+    """
+    Pool of preallocated arrays, keyed by shape and dtype. Every pipeline
+    owns a pool, and its frames take their scratch images from it and give
+    them back once done, so after the first frames a pipeline allocates no
+    new images. The pool keeps track of its high-water mark, i.e. the most
+    buffers in use at once, which bounds the memory it holds.
+    """
+
+    def __init__(self):
+        self.free = {}
+        self.lock = threading.Lock()
+
+        # Counters of buffers allocated, and in use now and at most
+        self.allocated = 0
+        self.allocated_bytes = 0
+        self.in_use = 0
+        self.high_water = 0
+
+    def take(self, shape, dtype=np.uint8):
+        """
+        Returns a buffer of the given shape and dtype. Its contents are
+        undefined.
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.lock:
+            free = self.free.get(key)
+            buffer = free.pop() if free else None
+            self.in_use += 1
+            self.high_water = max(self.high_water, self.in_use)
+            if buffer is None:
+                self.allocated += 1
+        if buffer is None:
+            buffer = np.empty(shape, dtype=dtype)
+            with self.lock:
+                self.allocated_bytes += buffer.nbytes
+        return buffer
+
+    def give(self, buffer):
+        """ Returns a buffer to the pool. The caller must not use it again. """
+        key = (buffer.shape, buffer.dtype.str)
+        with self.lock:
+            self.free.setdefault(key, []).append(buffer)
+            self.in_use -= 1
+
+    def stats(self):
+        """ Returns the counters of the pool. """
+        with self.lock:
+            return {"allocated": self.allocated,
+                    "allocated_bytes": self.allocated_bytes,
+                    "in_use": self.in_use,
+                    "high_water": self.high_water}
@@ -0,0 +1,118 @@
+import cv2
+import threading
+
+class FrameRing(object):
+    """
+    Bounded ring buffer of frames, written by one producer and read by one
+    consumer. When the buffer is full, a new frame overwrites the oldest
+    unread frame, which is counted as dropped, so the producer never blocks.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.slots = [None] * size
+        self.head = 0
+        self.count = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        # Counters of frames written and overwritten before being read
+        self.written = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def put(self, frame):
+        """ Writes a frame, overwriting the oldest unread frame if full. """
+        with self.condition:
+            if self.count == self.size:
+                self.head = (self.head + 1) % self.size
+                self.count -= 1
+                self.dropped += 1
+            self.slots[(self.head + self.count) % self.size] = frame
+            self.count += 1
+            self.written += 1
+            self.max_depth = max(self.max_depth, self.count)
+            self.condition.notify()
+
+    def get(self):
+        """
+        Returns the oldest unread frame, waiting for one if needed. Returns
+        None once the buffer is closed and empty.
+        """
+        with self.condition:
+            while self.count == 0 and not self.closed:
+                # Waiting with a timeout keeps the thread interruptible
+                self.condition.wait(1.0)
+            if self.count == 0:
+                return None
+            frame = self.slots[self.head]
+            self.slots[self.head] = None
+            self.head = (self.head + 1) % self.size
+            self.count -= 1
+            return frame
+
+    def close(self):
+        """ Wakes up the consumer, which reads the remaining frames. """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def depth(self):
+        """ Returns the number of unread frames. """
+        with self.condition:
+            return self.count
+
+class CaptureThread(threading.Thread):
+    """
+    Reads frames from a video capture on a background thread into a
+    FrameRing, so reading the camera overlaps with detection. Frames are
+    mirrored on the capture thread as well.
+    """
+
+    def __init__(self, capture, size=4, flip=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.capture = capture
+        self.flip = flip
+        self.ring = FrameRing(size)
+        self.running = True
+        self.failed = False
+
+    def run(self):
+        try:
+            while self.running:
+                retval, frame = self.capture.read()
+                if not retval:
+                    self.failed = True
+                    break
+                if self.flip:
+                    # Mirror the frames to mimic webcam motion
+                    frame = cv2.flip(frame, 1)
+                self.ring.put(frame)
+        finally:
+            self.ring.close()
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def pairs(self):
+        """
+        Yields overlapping pairs of consecutive frames (t-1, t), so every
+        transition between the frames read is analysed once. If frames were
+        dropped, a pair spans the gap.
+        """
+        prev = self.ring.get()
+        while prev is not None:
+            frame = self.ring.get()
+            if frame is None:
+                return
+            yield prev, frame
+            prev = frame
+
+    def stats(self):
+        """ Returns the counters of frames captured, dropped and waiting. """
+        return {"captured": self.ring.written,
+                "dropped": self.ring.dropped,
+                "depth": self.ring.depth(),
+                "max_depth": self.ring.max_depth}
@@ -0,0 +1,79 @@
+import base64
+import cv2
+import detect
+import numpy as np
+import struct
+
+# Leading bytes of the image formats a browser canvas can produce
+IMAGE_MAGIC = ("\xff\xd8", "\x89PNG", "RIFF")
+
+# Leading byte of geometry replies
+GEOMETRY_MAGIC = "G"
+
+# Geometry reply header: direction (x, y), best box and window box
+# (x, y, width, height), number of candidate boxes and of flow vectors.
+# The candidates follow as (x, y, width, height) int16s, then the flow
+# vectors as (x0, y0, x1, y1) float32s, all little-endian.
+GEOMETRY_HEADER = struct.Struct("<2f4h4hHH")
+
+# Encoder parameters setting the quality of each lossy image format. WebP
+# encoding needs OpenCV 2.4.4+, whose constant is 64.
+QUALITY_PARAMS = {
+    ".jpg": cv2.cv.CV_IMWRITE_JPEG_QUALITY,
+    ".webp": getattr(cv2.cv, "CV_IMWRITE_WEBP_QUALITY", 64),
+}
+
+def decode_frame(message):
+    """
+    Decodes a frame received from the client into a BGR image, without
+    touching the filesystem. The message may either hold the raw bytes of
+    an encoded image (a binary websocket frame), or the same bytes encoded
+    in base64, optionally as a data url. Returns None if the message does
+    not contain a valid image.
+    """
+    if isinstance(message, unicode):
+        message = message.encode("ascii", "ignore")
+    if not message.startswith(IMAGE_MAGIC):
+        if message.startswith("data:"):
+            message = message[message.find(",") + 1:]
+        try:
+            message = base64.b64decode(message)
+        except TypeError:
+            return None
+    buf = np.frombuffer(message, dtype=np.uint8)
+    if buf.size == 0:
+        return None
+    return cv2.imdecode(buf, cv2.CV_LOAD_IMAGE_COLOR)
+
+def encode_frame(frame, ext=".png", params=None, quality=None):
+    """
+    Encodes a BGR image in memory into the format given by ext, and returns
+    the encoded bytes as a string. quality (0-100) applies to ".jpg" and
+    ".webp" only.
+    """
+    params = list(params or [])
+    if quality is not None and ext in QUALITY_PARAMS:
+        params += [QUALITY_PARAMS[ext], int(quality)]
+    retval, buf = cv2.imencode(ext, frame, params)
+    if not retval:
+        raise Exception("couldn't encode frame as " + ext)
+    return buf.tostring()
+
+def encode_geometry(direction, largest, window, candidates, vectors):
+    """
+    Encodes the overlay of a processed frame into a compact binary reply,
+    for clients that draw the overlay on their own copy of the frame:
+    the overall direction, the largest box, the window box of the filter
+    (None if there is none), the candidate boxes (N, 4) and the flow
+    vectors (K, 2, 2). See GEOMETRY_HEADER for the layout.
+    """
+    if window is None:
+        window = detect.Rect(0, 0, 0, 0)
+    candidates = np.asarray(candidates, dtype="<i2").reshape(-1, 4)
+    vectors = np.asarray(vectors, dtype="<f4").reshape(-1, 4)
+    header = GEOMETRY_HEADER.pack(
+        direction[0], direction[1],
+        largest.x, largest.y, largest.width, largest.height,
+        window.x, window.y, window.width, window.height,
+        len(candidates), len(vectors))
+    return GEOMETRY_MAGIC + header + candidates.tostring() + vectors.tostring()
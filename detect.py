@@ -1,10 +1,93 @@
 import cv2
 import math
 import numpy as np
+import threading
 
-def bgr2gray(frame):
-    """ Convert a frame to grayscale. """
-    return cv2.equalizeHist(cv2.cvtColor(frame, cv2.cv.CV_BGR2GRAY))
+def bgr2gray(frame, out=None):
+    """
+    Convert a frame to grayscale. If out is given, the result is written
+    into it.
+    """
+    gray = cv2.cvtColor(frame, cv2.cv.CV_BGR2GRAY, out)
+    return cv2.equalizeHist(gray, gray)
+
+class FrameContext(object):
+    """
+    Wraps a frame and lazily computes the images derived from it, each at
+    most once per frame. Stages that need a derived image take a context
+    instead of a raw frame, so they share the conversions. If a BufferPool
+    is given, the derived images are taken from it, and given back by
+    release. Crops of varying sizes should set bound to the shape of the
+    whole frame: their images are then cut from buffers of that shape, so
+    the pool does not keep a buffer for every size of crop.
+    """
+
+    def __init__(self, frame, pool=None, bound=None):
+        self.frame = frame
+        self.pool = pool
+        self.bound = bound
+        self.buffers = []
+        self._gray = None
+        self._equalized = None
+        self._small = None
+        self._small_scale = None
+
+        # Set by Pipeline, to release the context once no frame uses it
+        self.finished = False
+        self.dropped = False
+
+    def take(self, shape):
+        """ Returns a new uint8 image of the given shape. """
+        if self.pool is None:
+            return np.empty(shape, dtype=np.uint8)
+        if self.bound is None:
+            buffer = self.pool.take(shape, np.uint8)
+            self.buffers.append(buffer)
+            return buffer
+        buffer = self.pool.take(self.bound, np.uint8)
+        self.buffers.append(buffer)
+        return buffer.reshape(-1)[:np.prod(shape)].reshape(shape)
+
+    def release(self):
+        """ Gives the derived images back to the pool. """
+        for buffer in self.buffers:
+            self.pool.give(buffer)
+        self.buffers = []
+        self._gray = None
+        self._equalized = None
+        self._small = None
+
+    @staticmethod
+    def of(frame):
+        """ Wraps frame in a context, unless it already is one. """
+        if isinstance(frame, FrameContext):
+            return frame
+        return FrameContext(frame)
+
+    def gray(self):
+        """ Returns the grayscale frame. """
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.frame, cv2.cv.CV_BGR2GRAY,
+                                      self.take(self.frame.shape[:2]))
+        return self._gray
+
+    def equalized(self):
+        """ Returns the grayscale frame with its histogram equalized. """
+        if self._equalized is None:
+            self._equalized = cv2.equalizeHist(self.gray(),
+                                               self.take(self.frame.shape[:2]))
+        return self._equalized
+
+    def small(self, scale):
+        """ Returns the grayscale frame, downsampled by scale. """
+        if self._small is None or self._small_scale != scale:
+            shape = self.frame.shape
+            size = (int(round(shape[1] * scale)), int(round(shape[0] * scale)))
+            self._small = cv2.resize(self.gray(), size,
+                                     self.take((size[1], size[0])),
+                                     interpolation=cv2.INTER_AREA)
+            self._small_scale = scale
+        return self._small
 
 class VMath(object):
     """ Static wrapper class for functions dealing with vector arithmetic. """
@@ -57,27 +140,70 @@ class Rect(object):
     def center(self):
         return (int(self.x + self.width / 2), int(self.y + self.height / 2))
 
-    def mask(self, frame):
-        """ Returns a mask for frame, using the bounding box. """
-        mask = np.zeros(shape=(frame.shape[0], frame.shape[1]),
-                        dtype=np.dtype("uint8"))
-        (u, v) = np.ix_(range(self.y, min(self.y + self.height, frame.shape[0])),
-                        range(self.x, min(self.x + self.width, frame.shape[1])))
-        indices = (u.astype(int), v.astype(int))
-        mask[indices] += 1
-        return mask
-
-    def filter(self, frame):
-        mask = np.zeros(shape=(frame.shape[0], frame.shape[1]),
-                        dtype=np.dtype("uint8"))
-        (u, v) = np.ix_(range(max(0, self.y),
-                              min(self.y + self.height, frame.shape[0])),
-                        range(max(0, self.x),
-                              min(self.x + self.width, frame.shape[1])))
-        indices = (u.astype(int), v.astype(int))
-        result = np.zeros(frame.shape, dtype=frame.dtype)
-        result[indices] = frame[indices]
-        return result
+    def clip(self, shape, margin=0):
+        """
+        Returns this rectangle grown by margin on every side, and clipped to
+        a frame with the given shape.
+        """
+        x0 = max(0, self.x - margin)
+        y0 = max(0, self.y - margin)
+        x1 = min(shape[1], self.x + self.width + margin)
+        y1 = min(shape[0], self.y + self.height + margin)
+        return Rect(x0, y0, max(0, x1 - x0), max(0, y1 - y0))
+
+    def slices(self, shape):
+        """
+        Returns the row and column slices covered by this rectangle, clipped
+        to a frame with the given shape.
+        """
+        window = self.clip(shape)
+        return (slice(window.y, window.y + window.height),
+                slice(window.x, window.x + window.width))
+
+    def mask(self, frame, out=None):
+        """
+        Returns a mask for frame, using the bounding box. If out is given,
+        the mask is written into it instead of a new array.
+        """
+        if out is None:
+            out = np.zeros(shape=(frame.shape[0], frame.shape[1]),
+                           dtype=np.dtype("uint8"))
+        else:
+            out.fill(0)
+        out[self.slices(frame.shape)] = 1
+        return out
+
+    def filter(self, frame, out=None):
+        """
+        Returns a copy of frame where the pixels outside the bounding box are
+        zeroed out. If out is given, the result is written into it.
+        """
+        if out is None:
+            out = np.zeros(frame.shape, dtype=frame.dtype)
+        else:
+            out.fill(0)
+        window = self.slices(frame.shape)
+        out[window] = frame[window]
+        return out
+
+    def area(self):
+        return self.width * self.height
+
+    def iou(self, other):
+        """
+        Returns the intersection over union of this rectangle and other.
+        Two empty rectangles, i.e. no object on either side, count as a
+        perfect match.
+        """
+        x0 = max(self.x, other.x)
+        y0 = max(self.y, other.y)
+        x1 = min(self.x + self.width, other.x + other.width)
+        y1 = min(self.y + self.height, other.y + other.height)
+        intersection = max(0, x1 - x0) * max(0, y1 - y0)
+        union = self.area() + other.area() - intersection
+        if union == 0:
+            return 1.
+        return float(intersection) / union
 
     def draw(self, frame, color):
         cv2.rectangle(frame, (self.x, self.y),
@@ -91,6 +217,11 @@ class CascadeDetector(object):
     """
     Wrapper class for a CascadeClassifier object. Provides utility methods
     to find the largest object and to mask objects out of frames.
+
+    OpenCV classifiers keep scratch state for the image being searched, so a
+    classifier cannot be used by two threads at once. The detector keeps a
+    free list of classifiers instead, and find borrows one for the duration
+    of the search. This makes a single detector safe to share.
     """
 
     def __init__(self, cascade_name):
@@ -98,10 +229,29 @@ class CascadeDetector(object):
         Constructor. Throws exception if opencv cannot open the cascade with
         the provided name.
         """
-        cascade = cv2.CascadeClassifier(cascade_name)
+        self.cascade_name = cascade_name
+        self.lock = threading.Lock()
+        self.loaded = 0
+        self.cascades = [self.load()]
+
+    def load(self):
+        """ Parses a new classifier from the cascade file. """
+        cascade = cv2.CascadeClassifier(self.cascade_name)
         if cascade.empty():
-            raise Exception("couldn't load cascade: " + cascade_name)
-        self.cascade = cascade
+            raise Exception("couldn't load cascade: " + self.cascade_name)
+        with self.lock:
+            self.loaded += 1
+        return cascade
+
+    def reserve(self, n):
+        """
+        Loads classifiers until n threads can search concurrently without
+        having to parse the cascade file.
+        """
+        while self.loaded < n:
+            cascade = self.load()
+            with self.lock:
+                self.cascades.append(cascade)
 
     def find(self,
              frame,
@@ -112,18 +262,112 @@ class CascadeDetector(object):
              maxSize=None):
         """
         Finds all the objects in the frame and returns a list of rectangle
-        objects (x, y, width, height).
+        objects (x, y, width, height). frame may be a FrameContext.
+        """
+        gray = FrameContext.of(frame).equalized()
+        return self.find_gray(gray, scaleFactor=scaleFactor,
+                              minNeighbors=minNeighbors, flags=flags,
+                              minSize=minSize, maxSize=maxSize)
+
+    def find_gray(self,
+                  gray,
+                  scaleFactor=1.1,
+                  minNeighbors=3,
+                  flags=cv2.cv.CV_HAAR_SCALE_IMAGE | cv2.cv.CV_HAAR_DO_CANNY_PRUNING,
+                  minSize=None,
+                  maxSize=None):
+        """
+        Same as find, but searches an already equalized grayscale image.
         """
-        gray = bgr2gray(frame)
-        objects = self.cascade.detectMultiScale(gray, scaleFactor=scaleFactor,
-                                                minNeighbors=minNeighbors,
-                                                flags=flags,
-                                                minSize=minSize, maxSize=maxSize)
+        with self.lock:
+            cascade = self.cascades.pop() if self.cascades else None
+        if cascade is None:
+            cascade = self.load()
+        try:
+            objects = cascade.detectMultiScale(gray, scaleFactor=scaleFactor,
+                                               minNeighbors=minNeighbors,
+                                               flags=flags,
+                                               minSize=minSize, maxSize=maxSize)
+        finally:
+            with self.lock:
+                self.cascades.append(cascade)
         if objects is None or len(objects) == 0:
             objects = []
         return objects
 
-    def largest(self, frame, objects, draw=True,
+    def find_within(self, frame, rect, margin=0, minSize=None, pool=None,
+                    **kwargs):
+        """
+        Finds the objects within rect, grown by margin, by only searching
+        a cropped view of the frame. Returns the rectangles in the coordinates
+        of the frame. If a BufferPool is given, the images derived from the
+        crop are taken from it. Takes the same keyword arguments as find.
+        """
+        frame = FrameContext.of(frame).frame
+        window = rect.clip(frame.shape, margin)
+        if minSize is not None and (window.width < minSize[0] or
+                                    window.height < minSize[1]):
+            return []
+        if window.width == 0 or window.height == 0:
+            return []
+        crop = FrameContext(frame[window.y:window.y + window.height,
+                                  window.x:window.x + window.width],
+                            pool, bound=frame.shape[:2])
+        try:
+            objects = self.find(crop, minSize=minSize, **kwargs)
+        finally:
+            crop.release()
+        if len(objects) > 0:
+            objects[:, 0] += window.x
+            objects[:, 1] += window.y
+        return objects
+
+    def find_coarse(self, frame, scale=0.5, margin=10, coarseMinNeighbors=3,
+                    minSize=None, pool=None, **kwargs):
+        """
+        Finds objects coarse to fine. The equalized frame is first searched
+        downscaled by scale, with coarseMinNeighbors, for candidates. Each
+        candidate region, grown by margin, is then searched again at full
+        resolution to confirm it. Returns the confirmed rectangles in the
+        coordinates of the frame. If a BufferPool is given, the downscaled
+        frame is taken from it. Takes the same keyword arguments as find.
+        """
+        gray = FrameContext.of(frame).equalized()
+        size = (int(round(gray.shape[1] * scale)), int(round(gray.shape[0] * scale)))
+        scratch = FrameContext(gray, pool)
+        try:
+            small = cv2.resize(gray, size, scratch.take((size[1], size[0])),
+                               interpolation=cv2.INTER_AREA)
+            coarseMinSize = None
+            if minSize is not None:
+                coarseMinSize = (int(minSize[0] * scale), int(minSize[1] * scale))
+            candidates = self.find_gray(small, minNeighbors=coarseMinNeighbors,
+                                        minSize=coarseMinSize,
+                                        **dict((k, kwargs[k]) for k in kwargs
+                                               if k != "minNeighbors"))
+        finally:
+            scratch.release()
+
+        # Confirm the candidates at full resolution
+        objects = []
+        for candidate in candidates:
+            [x, y, width, height] = candidate[:4]
+            window = Rect(x / scale, y / scale, width / scale,
+                          height / scale).clip(gray.shape, margin)
+            if minSize is not None and (window.width < minSize[0] or
+                                        window.height < minSize[1]):
+                continue
+            found = self.find_gray(gray[window.y:window.y + window.height,
+                                        window.x:window.x + window.width],
+                                   minSize=minSize, **kwargs)
+            for [x, y, width, height] in found:
+                rect = (x + window.x, y + window.y, width, height)
+                if rect not in objects:
+                    objects.append(rect)
+        return np.array(objects, dtype=np.int32) if objects else []
+
+    @staticmethod
+    def largest(frame, objects, draw=True,
                 color=Color.YELLOW, bestColor=Color.GREEN):
         """
         Returns the largest object in the list of objects, and optionally draws
@@ -140,19 +384,89 @@ class CascadeDetector(object):
                       (best.x + best.width, best.y + best.height), bestColor)
         return best
 
-    def remove(self, frame, objects):
+    def remove(self, frame, objects, out=None):
         """
         Returns a copy of frame where the pixels within bounding boxes of
-        the detected objects are zeroed out.
+        the detected objects are zeroed out. If out is given, the result is
+        written into it; out may be frame itself to mask in place.
         """
-        result = frame.copy()
+        if out is None:
+            out = frame.copy()
+        elif out is not frame:
+            out[...] = frame
         for rect in objects:
             [x, y, width, height] = rect[:4]
-            (u, v) = np.ix_(range(int(y), int(y + width)),
-                            range(int(x), int(x + height)))
-            submatrix = (u.astype(int), v.astype(int))
-            result[submatrix] = 0
-        return result
+            out[Rect(x, y, width, height).slices(frame.shape)] = 0
+        return out
+
+class CascadeRegistry(object):
+    """
+    Process-wide registry of cascade detectors. Each cascade file is parsed
+    once, and the resulting detector is shared by every pipeline, so creating
+    a pipeline does not touch the filesystem.
+    """
+
+    def __init__(self):
+        self.detectors = {}
+        self.lock = threading.Lock()
+
+    def get(self, cascade_name):
+        """ Returns the detector for the cascade, loading it on first use. """
+        with self.lock:
+            detector = self.detectors.get(cascade_name)
+            if detector is None:
+                detector = CascadeDetector(cascade_name)
+                self.detectors[cascade_name] = detector
+        return detector
+
+    def preload(self, cascade_names, copies=1):
+        """
+        Loads the cascades ahead of time, with enough classifiers for copies
+        threads to use each cascade concurrently.
+        """
+        for cascade_name in cascade_names:
+            self.get(cascade_name).reserve(copies)
+
+class TemplateTracker(object):
+    """
+    Follows an object between detections by matching a template of the
+    object, cut from the frame it was last detected in, with normalized
+    cross correlation. Much cheaper than a cascade search, but it drifts,
+    so a detector should restart it regularly.
+    """
+
+    def __init__(self, method=cv2.TM_CCOEFF_NORMED):
+        self.method = method
+        self.template = None
+
+    def start(self, gray, rect):
+        """ Starts tracking the object within rect of a grayscale frame. """
+        window = rect.clip(gray.shape)
+        if window.width == 0 or window.height == 0:
+            self.template = None
+            return
+        self.template = gray[window.slices(gray.shape)].copy()
+
+    def stop(self):
+        self.template = None
+
+    def tracking(self):
+        return self.template is not None
+
+    def track(self, gray, region):
+        """
+        Finds the template within region of a grayscale frame. Returns the
+        matched rectangle and the match score, from -1 to 1, or (None, -1) if
+        region is too small to hold the template.
+        """
+        region = region.clip(gray.shape)
+        (height, width) = self.template.shape[:2]
+        if region.width < width or region.height < height:
+            return None, -1.
+        scores = cv2.matchTemplate(gray[region.slices(gray.shape)],
+                                   self.template, self.method)
+        (min_score, score, min_loc, (x, y)) = cv2.minMaxLoc(scores)
+        return Rect(region.x + x, region.y + y, width, height), score
 
 class LKOpticalFlow(object):
     """
@@ -160,9 +474,63 @@ class LKOpticalFlow(object):
     Lucas-Kanade.
     """
 
-    def __init__(self, min_threshold=5, max_threshold=50):
+    def __init__(self, min_threshold=5, max_threshold=50, track=False,
+                 min_features=20):
+        """
+        Constructor. If track is set, the points tracked into the second frame
+        are carried forward as the features of the next call, and corners are
+        only detected again once fewer than min_features points survive.
+        """
         self.min_threshold = min_threshold
         self.max_threshold = max_threshold
+        self.track = track
+        self.min_features = min_features
+        self.features = None
+        self.features_context = None
+
+        # Motion vectors (old point, new point) kept in the last call
+        self.vectors = np.zeros((0, 2, 2), dtype=np.float32)
+
+    def carried(self, context, mask=None):
+        """
+        Returns the points tracked in the last call that lie inside the mask,
+        if they were tracked into the frame of this context, or None otherwise.
+        """
+        if not self.track or self.features is None or self.features_context is not context:
+            return None
+        features = self.features
+        if mask is not None:
+            points = features.reshape(-1, 2).astype(int)
+            inside = ((points[:, 0] >= 0) & (points[:, 0] < mask.shape[1]) &
+                      (points[:, 1] >= 0) & (points[:, 1] < mask.shape[0]))
+            inside[inside] = mask[points[inside, 1], points[inside, 0]] != 0
+            features = features[inside]
+        return features
+
+    @staticmethod
+    def median_motion(frame_prev, frame_next, mask, maxCorners=20,
+                      qualityLevel=0.01, minDistance=3):
+        """
+        Returns the median motion of the corners within the mask between
+        two frames, or (0, 0) if none could be tracked. The median ignores
+        the points of a smaller object moving across the masked region.
+        Both frames may be FrameContexts. Nothing is drawn.
+        """
+        gray_prev = FrameContext.of(frame_prev).equalized()
+        gray_next = FrameContext.of(frame_next).equalized()
+        features_prev = cv2.goodFeaturesToTrack(gray_prev, maxCorners,
+                                                qualityLevel, minDistance,
+                                                mask=mask)
+        if features_prev is None or len(features_prev) == 0:
+            return (0, 0)
+        features_next, status, err = cv2.calcOpticalFlowPyrLK(gray_prev, gray_next,
+                                                                features_prev)
+        found = status.ravel() == 1
+        if not found.any():
+            return (0, 0)
+        motion = np.median((features_next - features_prev).reshape(-1, 2)[found],
+                           axis=0)
+        return (float(motion[0]), float(motion[1]))
 
     def direction(self, frame_prev, frame_next, maxCorners=100,
                   qualityLevel=0.01, minDistance=0.01, mask=None,
@@ -170,20 +538,28 @@ class LKOpticalFlow(object):
         """
         Uses Lucas-Kanade to find corresponding points in the second frame
         using features from the first frame. Returns the overall direction of
-        the scene and the annotated frame.
+        the scene and the annotated frame. Both frames may be FrameContexts.
         """
-        gray_prev = bgr2gray(frame_prev)
-        gray_next = bgr2gray(frame_next)
-
-        # Find features in the first frame
-        features_prev = cv2.goodFeaturesToTrack(gray_prev, maxCorners,
-                                                qualityLevel, minDistance,
-                                                mask=mask)
+        context_prev = FrameContext.of(frame_prev)
+        context_next = FrameContext.of(frame_next)
+        frame_prev = context_prev.frame
+        gray_prev = context_prev.equalized()
+        gray_next = context_next.equalized()
+
+        # Reuse the points tracked into the first frame, or find new features
+        features_prev = self.carried(context_prev, mask)
+        if features_prev is None or len(features_prev) < self.min_features:
+            features_prev = cv2.goodFeaturesToTrack(gray_prev, maxCorners,
+                                                    qualityLevel, minDistance,
+                                                    mask=mask)
+        self.features = None
+        self.features_context = None
+        self.vectors = np.zeros((0, 2, 2), dtype=np.float32)
 
         # Overall direction of the scene
         direction = (0, 0)
 
-        if features_prev is None:
+        if features_prev is None or len(features_prev) == 0:
             return (direction, frame_prev)
         for f in features_prev:
             cv2.circle(frame_prev, (f[0][0], f[0][1]), 2, color_prev)
@@ -192,18 +568,29 @@ class LKOpticalFlow(object):
         features_next, status, err = cv2.calcOpticalFlowPyrLK(gray_prev, gray_next,
                                                                 features_prev)
 
+        # Keep the features found in the second frame, and threshold distances
+        # to avoid small and big movements
+        found = status.ravel() == 1
+        motion = (features_next - features_prev).reshape(-1, 2)
+        distance = np.sqrt((motion * motion).sum(axis=1))
+        moved = found & (self.min_threshold < distance) & (distance < self.max_threshold)
+
         # Compute overall direction of the scene
-        for i in range(0, len(features_prev)):
-            # Ff the feature was found in the second frame
-            if status[i] == 1:
-                oldpt = (features_prev[i][0][0], features_prev[i][0][1])
-                newpt = (features_next[i][0][0], features_next[i][0][1])
-
-                # Threshold distances to avoid small and big movements
-                if self.min_threshold < VMath.dist(oldpt, newpt) < self.max_threshold:
-                    cv2.circle(frame_prev, newpt, 2, color_next)
-                    cv2.line(frame_prev, oldpt, newpt, color_next)
-                    direction = VMath.add(direction, VMath.subtract(newpt, oldpt))
+        if moved.any():
+            total = motion[moved].sum(axis=0)
+            direction = (float(total[0]), float(total[1]))
+        self.vectors = np.hstack((features_prev[moved], features_next[moved]))
+        for oldpt, newpt in zip(features_prev[moved].reshape(-1, 2),
+                                features_next[moved].reshape(-1, 2)):
+            oldpt = VMath.int_tuple(oldpt)
+            newpt = VMath.int_tuple(newpt)
+            cv2.circle(frame_prev, newpt, 2, color_next)
+            cv2.line(frame_prev, oldpt, newpt, color_next)
+
+        # Carry the tracked points forward to the next call
+        if self.track:
+            self.features = features_next[found]
+            self.features_context = context_next
 
         # Draw the overall motion
         shape = frame_prev.shape
@@ -215,7 +602,9 @@ class LKOpticalFlow(object):
 class BGSubtractor(object):
     """
     Removes background from a sequence of frames by maintaining a history
-    of frames seen so far.
+    of frames seen so far. The history is a preallocated ring buffer, so
+    updating it never copies the other frames, and so are the intermediate
+    images.
     """
 
     def __init__(self, nframes, threshold=20, ksize=(15,15)):
@@ -225,35 +614,106 @@ class BGSubtractor(object):
         self.nframes = nframes
         self.threshold = threshold
         self.ksize = ksize
-        self.frames = []
+        self.history = None
+        self.index = 0
+        self.count = 0
 
-    def bgremove(self, frame):
+    def bgremove(self, frame, out=None):
         """
         Removes the background of the frame, using thresholding the difference with
         the provided the threshold. If fewer than nframes have been seen, the frame
-        will be returned unchanged.
+        will be returned unchanged. If out is given, the result is written into it.
         """
+        # Allocate the history on the first frame, or if the frame size changes
+        if self.history is None or self.history.shape[1:] != frame.shape:
+            self.history = np.empty((self.nframes,) + frame.shape, dtype=frame.dtype)
+            self.difference = np.empty(frame.shape, dtype=frame.dtype)
+            self.blurred = np.empty(frame.shape, dtype=frame.dtype)
+            self.gray = np.empty(frame.shape[:2], dtype=frame.dtype)
+            self.index = 0
+            self.count = 0
+
         # If we don't have enough frames in our history, return the frame
-        if len(self.frames) < self.nframes:
-            self.frames.append(frame)
+        if self.count < self.nframes:
+            self.history[self.count] = frame
+            self.count += 1
             return frame
 
-        # Remove the oldest frame our history and append the new frame
-        original = self.frames[0]
-        self.frames = self.frames[1:]
-        self.frames.append(frame)
+        # Subtract the current frame and the oldest frame, then replace the
+        # oldest frame in our history with the new frame
+        difference = cv2.absdiff(frame, self.history[self.index], self.difference)
+        self.history[self.index] = frame
+        self.index = (self.index + 1) % self.nframes
 
-        # Subtract the current frame and the oldest frame
-        difference = cv2.absdiff(frame, original)
-        _, difference = cv2.threshold(difference, self.threshold, 255, cv2.THRESH_BINARY)
-        difference = cv2.GaussianBlur(difference, self.ksize, 1)
-        gray = bgr2gray(difference)
-        indices = gray.nonzero()
+        _, difference = cv2.threshold(difference, self.threshold, 255,
+                                      cv2.THRESH_BINARY, difference)
+        difference = cv2.GaussianBlur(difference, self.ksize, 1, self.blurred)
+        gray = bgr2gray(difference, self.gray)
 
         # Set entries to zero whose difference did not pass the threshold
-        mask = np.zeros(frame.shape, dtype=frame.dtype)
-        mask[indices] = frame[indices]
-        return mask
+        if out is None:
+            out = np.zeros(frame.shape, dtype=frame.dtype)
+        else:
+            out.fill(0)
+        return cv2.bitwise_and(frame, frame, out, mask=gray)
+
+class RunningAverageSubtractor(object):
+    """
+    Removes background from a sequence of frames by maintaining an
+    exponential running average of the grayscale frames seen so far. Only a
+    single background frame is kept in memory, and the thresholding and
+    blurring work on one channel instead of three.
+    """
+
+    def __init__(self, nframes, alpha=0.05, threshold=20, ksize=(15,15)):
+        """
+        Constructor. alpha is the weight of each new frame in the average,
+        and nframes is the number of frames to average before removing the
+        background.
+        """
+        self.nframes = nframes
+        self.alpha = alpha
+        self.threshold = threshold
+        self.ksize = ksize
+        self.background = None
+        self.count = 0
+
+    def bgremove(self, frame, out=None):
+        """
+        Removes the background of the frame, by thresholding its difference
+        with the running average. If fewer than nframes have been seen, the
+        frame will be returned unchanged. If out is given, the result is
+        written into it.
+        """
+        if self.background is None or self.background.shape != frame.shape[:2]:
+            # Allocate the background and intermediate images once
+            self.gray = cv2.cvtColor(frame, cv2.cv.CV_BGR2GRAY)
+            self.background = self.gray.astype(np.float32)
+            self.background8 = np.empty_like(self.gray)
+            self.difference = np.empty_like(self.gray)
+            self.blurred = np.empty_like(self.gray)
+            self.count = 1
+            return frame
+        gray = cv2.cvtColor(frame, cv2.cv.CV_BGR2GRAY, self.gray)
+
+        # Subtract the current frame and the background, then fold the
+        # current frame into the background
+        difference = cv2.absdiff(gray, cv2.convertScaleAbs(self.background,
+                                                           self.background8),
+                                 self.difference)
+        cv2.accumulateWeighted(gray, self.background, self.alpha)
+        if self.count < self.nframes:
+            self.count += 1
+            return frame
+
+        # Keep the pixels whose difference passed the threshold
+        _, difference = cv2.threshold(difference, self.threshold, 255,
+                                      cv2.THRESH_BINARY, difference)
+        difference = cv2.GaussianBlur(difference, self.ksize, 1, self.blurred)
+        if out is None:
+            return cv2.bitwise_and(frame, frame, mask=difference)
+        out.fill(0)
+        return cv2.bitwise_and(frame, frame, out, mask=difference)
 
 class Kalman(object):
     """
@@ -354,3 +814,89 @@ class SimpleKalman(object):
                             actual.y + actual.height / 2 + direction[1] * self.scale - self.window_height / 2,
                             self.window_width, self.window_height)
         return self.box
+
+class KalmanTracker(object):
+    """
+    Tracks the hand with a constant-velocity Kalman Filter, with the same
+    interface as SimpleKalman. The state is (cx, cy, vx, vy, width, height),
+    and every entry of the state is measured: the optical flow direction,
+    multiplied by scale, is measured as the velocity. The model matrices
+    are built once and reused. When the hand is missed, the track coasts on
+    its velocity for max_misses frames before the window falls back to the
+    whole frame.
+    """
+
+    # Dimension of the state and of the measurements
+    N = 6
+
+    def __init__(self, width, height, window_width, window_height, scale=0.1,
+                 max_misses=3, dt=1.0, p_sigma=10., q_sigma=1., r_sigma=4.):
+        """
+        Params:
+            dt: time step between frames
+            p_sigma: initial error STD
+            q_sigma: process noise STD
+            r_sigma: measurement noise STD
+        """
+        self.width = width
+        self.height = height
+        self.window_width = window_width
+        self.window_height = window_height
+        self.scale = scale
+        self.max_misses = max_misses
+        self.p_sigma = p_sigma
+        self.A = np.identity(self.N)
+        self.A[0, 2] = dt
+        self.A[1, 3] = dt
+        self.Q = np.identity(self.N) * q_sigma * q_sigma
+        self.R = np.identity(self.N) * r_sigma * r_sigma
+        self.I = np.identity(self.N)
+
+        # State and error covariance, None until the hand is first found
+        self.x = None
+        self.P = None
+        self.misses = 0
+        self.box = Rect(0, 0, self.width, self.height)
+
+    def window(self, state):
+        """ Returns the search window centered on the state. """
+        return Rect(state[0] - self.window_width / 2,
+                    state[1] - self.window_height / 2,
+                    self.window_width, self.window_height)
+
+    def predict(self):
+        """
+        Return the prediction of the bounding box of the object.
+        """
+        if self.x is not None:
+            self.x = self.A.dot(self.x)
+            self.P = self.A.dot(self.P).dot(self.A.T) + self.Q
+            self.box = self.window(self.x)
+        return self.box
+
+    def correct(self, actual, direction):
+        """
+        Corrects our prediction using the measured position and velocity.
+        """
+        if actual.width == 0 and actual.height == 0:
+            self.misses += 1
+            if self.misses > self.max_misses:
+                self.x = None
+                self.P = None
+            if self.x is None:
+                self.box = Rect(0, 0, self.width, self.height)
+            return self.box
+
+        self.misses = 0
+        (cx, cy) = actual.center()
+        z = np.array([cx, cy, direction[0] * self.scale, direction[1] * self.scale,
+                      actual.width, actual.height], dtype=float)
+        if self.x is None:
+            self.x = z
+            self.P = self.I * self.p_sigma * self.p_sigma
+        else:
+            K = self.P.dot(np.linalg.inv(self.P + self.R))
+            self.x = self.x + K.dot(z - self.x)
+            self.P = (self.I - K).dot(self.P)
+        self.box = self.window(self.x)
+        return self.box
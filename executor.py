@@ -0,0 +1,109 @@
+import Queue
+import threading
+import traceback
+
+# Groups of stages that feed results back to themselves across frames: the
+# filter corrected at the end of a frame predicts the window of the next
+# frame. Each group runs as a single segment, from its first to its last
+# stage, so frames go through it strictly one at a time.
+FEEDBACK_GROUPS = [("window", "correct")]
+
+def segments(stage_list):
+    """
+    Splits the stages of a pipeline into segments, each run by one thread:
+    every stage on its own, except for the stages of a feedback group.
+    """
+    names = [stage.name for stage in stage_list]
+    result = []
+    i = 0
+    while i < len(stage_list):
+        end = i
+        for first, last in FEEDBACK_GROUPS:
+            if names[i] == first and last in names[i:]:
+                end = names.index(last, i)
+        result.append(stage_list[i:end + 1])
+        i = end + 1
+    return result
+
+class PipelinedExecutor(object):
+    """
+    Runs the stages of a pipeline on consecutive frames at once. Every
+    segment of stages (see segments) has its own thread, and hands each
+    frame over to the next segment through a queue, so segment k of frame t
+    runs while segment k-1 runs on frame t+1. Each stage still sees the
+    frames one at a time and in order, so stateful stages such as the
+    background subtractor need no changes. Most of the work is in OpenCV
+    calls, which release the GIL, so the segments use several cores.
+
+    Frames are submitted with submit, and their results are returned by
+    result in the same order, with up to however many frames the caller
+    allows in flight.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.segments = segments(pipeline.stages)
+        self.queues = [Queue.Queue() for i in range(len(self.segments) + 1)]
+        self.threads = []
+        for i, segment in enumerate(self.segments):
+            thread = threading.Thread(target=self.work,
+                                      args=(i, segment, self.queues[i],
+                                            self.queues[i + 1]))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.pending = 0
+
+    def work(self, index, segment, inbox, outbox):
+        """ Runs a segment on every state it receives, until it gets None. """
+        while True:
+            state = inbox.get()
+            if state is None:
+                outbox.put(None)
+                return
+            try:
+                if index == 0:
+                    # The second frame is the first frame of the next call,
+                    # which will be drawn on, so derive it before handing
+                    # the next call over
+                    state.context2.equalized()
+                self.pipeline.run(state, segment)
+            except Exception:
+                state.error = traceback.format_exc()
+                state.done = True
+            outbox.put(state)
+
+    def submit(self, frame1, frame2):
+        """ Starts the stages on a pair of frames. """
+        state = self.pipeline.begin(frame1, frame2)
+        self.pending += 1
+        self.queues[0].put(state)
+
+    def result(self):
+        """
+        Waits for the oldest submitted pair of frames to go through every
+        stage, and returns the same as Pipeline.detect.
+        """
+        state = self.queues[-1].get()
+        self.pending -= 1
+        if state.error is not None:
+            self.pipeline.release(state)
+            raise Exception("pipeline stage failed:\n" + state.error)
+        return self.pipeline.finish(state)
+
+    def stop(self):
+        """
+        Tells the threads to stop once the submitted frames went through,
+        without waiting for them.
+        """
+        self.queues[0].put(None)
+
+    def join(self):
+        """ Waits for the threads to stop. """
+        for thread in self.threads:
+            thread.join()
+
+    def close(self):
+        """ Stops the threads, once the submitted frames went through. """
+        self.stop()
+        self.join()
@@ -0,0 +1,144 @@
+import cv2
+import glob
+import numpy as np
+import os
+import struct
+import sys
+import time
+
+# File holding the raw frames of a recording, within its directory
+FRAMES_NAME = "frames.bin"
+
+# Identifies frame store files, and the version of the layout
+MAGIC = "FRMSTOR1"
+
+# Header: magic, frame count, capacity, height, width, channels, dtype.
+# Timestamps (float64, one per frame) follow the header, then the frames,
+# stored back to back in row-major order.
+HEADER = struct.Struct("<8sIIIII8s")
+HEADER_SIZE = 64
+
+class FrameWriter(object):
+    """
+    Writes raw frames into a memory-mapped frame store holding at most
+    capacity frames of the given shape and dtype. The frame count in the
+    header is updated on every write, so a partial recording can be read.
+    """
+
+    def __init__(self, path, shape, capacity, dtype=np.uint8):
+        if len(shape) == 2:
+            shape = shape + (1,)
+        self.path = path
+        self.shape = tuple(shape)
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+
+        size = (HEADER_SIZE + 8 * capacity +
+                capacity * np.prod(self.shape) * self.dtype.itemsize)
+        with open(path, "wb") as f:
+            f.truncate(size)
+        self.header = np.memmap(path, dtype=np.uint8, mode="r+",
+                                shape=(HEADER_SIZE,))
+        self.timestamps = np.memmap(path, dtype=np.float64, mode="r+",
+                                    offset=HEADER_SIZE, shape=(capacity,))
+        self.frames = np.memmap(path, dtype=self.dtype, mode="r+",
+                                offset=HEADER_SIZE + 8 * capacity,
+                                shape=(capacity,) + self.shape)
+        self.write_header()
+
+    def write_header(self):
+        header = HEADER.pack(MAGIC, self.count, self.capacity, self.shape[0],
+                             self.shape[1], self.shape[2], self.dtype.str)
+        self.header[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+
+    def write(self, frame, timestamp=None):
+        """ Appends a frame, taken at timestamp (seconds, default now). """
+        if self.count == self.capacity:
+            raise Exception("frame store is full: " + self.path)
+        self.frames[self.count] = frame.reshape(self.shape)
+        self.timestamps[self.count] = time.time() if timestamp is None else timestamp
+        self.count += 1
+        self.write_header()
+
+    def close(self):
+        self.frames.flush()
+        self.timestamps.flush()
+        self.header.flush()
+        del self.frames, self.timestamps, self.header
+
+class FrameStore(object):
+    """
+    Reads a frame store. Frames are zero-copy views into the memory-mapped
+    file. The default mode "c" maps the file copy-on-write, so callers may
+    draw on the frames, e.g. Pipeline.detect annotating its first frame,
+    without touching the recording; use mode "r" for read-only views.
+    """
+
+    def __init__(self, path, mode="c"):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+        if len(header) < HEADER.size or not header.startswith(MAGIC):
+            raise Exception("not a frame store: " + path)
+        (magic, count, capacity, height, width, channels,
+         dtype) = HEADER.unpack(header)
+        self.dtype = np.dtype(dtype.rstrip("\0"))
+        self.shape = (height, width, channels)
+        self.count = count
+        if count == 0:
+            self.timestamps = np.zeros(0)
+            self.frames = np.zeros((0,) + self.shape, dtype=self.dtype)
+            return
+        self.timestamps = np.memmap(path, dtype=np.float64, mode="r",
+                                    offset=HEADER_SIZE, shape=(count,))
+        self.frames = np.memmap(path, dtype=self.dtype, mode=mode,
+                                offset=HEADER_SIZE + 8 * capacity,
+                                shape=(count,) + self.shape)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.frames[i]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.frames[i]
+
+def exists(directory):
+    """ Returns whether the recording in directory has a frame store. """
+    return os.path.exists(os.path.join(directory, FRAMES_NAME))
+
+def load(directory):
+    """
+    Returns the frames of the recording in directory: the frame store if it
+    has one, otherwise the decoded images img*.jpg, in order.
+    """
+    if exists(directory):
+        return FrameStore(os.path.join(directory, FRAMES_NAME))
+    names = sorted(glob.glob(os.path.join(directory, "img*.jpg")))
+    return [cv2.imread(name) for name in names]
+
+def convert(directory, path=None):
+    """
+    Converts the images img*.jpg in directory into a frame store, by default
+    in the same directory. Returns the number of frames written.
+    """
+    names = sorted(glob.glob(os.path.join(directory, "img*.jpg")))
+    if len(names) == 0:
+        raise Exception("no frames in " + directory)
+    path = path or os.path.join(directory, FRAMES_NAME)
+    writer = None
+    for name in names:
+        frame = cv2.imread(name)
+        if writer is None:
+            writer = FrameWriter(path, frame.shape, len(names), frame.dtype)
+        writer.write(frame, os.path.getmtime(name))
+    writer.close()
+    return len(names)
+
+if __name__ == "__main__":
+    # Converts the JPEG recordings given, e.g. data/analysis data/full
+    for directory in sys.argv[1:] or ["data/analysis"]:
+        print "%s: %d frames" % (directory, convert(directory))
@@ -0,0 +1,128 @@
+import framestore
+import math
+import numpy as np
+import os
+import time
+from detect import Rect, VMath
+from pipeline import Pipeline
+
+# File holding the hand boxes of a recording, within its directory
+LABELS_NAME = "labels.txt"
+
+# Min IoU for the largest box to count as a hit
+HIT_IOU = 0.5
+
+# Min motion of the labelled hand, in pixels, for its direction to be scored
+MIN_MOTION = 2.
+
+def labels_path(directory):
+    return os.path.join(directory, LABELS_NAME)
+
+def load_labels(directory):
+    """
+    Reads the ground truth of the recording in directory. Every line holds
+    the index of a frame and the box of the hand in it:
+
+        # frame x y width height
+        0 120 80 60 90
+        1 0 0 0 0
+
+    where an empty box means there is no hand in the frame. Frames without
+    a line are not scored. Returns a dictionary of frame index to Rect.
+    """
+    labels = {}
+    with open(labels_path(directory)) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            [index, x, y, width, height] = [int(v) for v in line.split()]
+            labels[index] = Rect(x, y, width, height)
+    return labels
+
+def save_labels(directory, labels):
+    """ Writes a dictionary of frame index to Rect as the ground truth. """
+    with open(labels_path(directory), "w") as f:
+        f.write("# frame x y width height\n")
+        for index in sorted(labels):
+            box = labels[index]
+            f.write("%d %d %d %d %d\n" % (index, box.x, box.y, box.width, box.height))
+
+def angle(u, v):
+    """ Returns the angle between two vectors, in degrees. """
+    cos = (u[0] * v[0] + u[1] * v[1]) / (VMath.norm(u) * VMath.norm(v))
+    return math.degrees(math.acos(max(-1., min(1., cos))))
+
+def score(boxes, directions, labels):
+    """
+    Scores the largest boxes and directions returned by detect for the
+    frames of a recording, where the result for frame i comes from the pair
+    (i, i+1). Returns the mean IoU and the hit rate of the boxes over the
+    labelled frames, and the mean angle in degrees between the directions
+    and the motion of the labelled hand, over the frames where both moved.
+    The magnitude of the direction depends on the number of tracked points,
+    so only its angle is scored.
+    """
+    ious = []
+    errors = []
+    for index, (box, direction) in enumerate(zip(boxes, directions)):
+        label = labels.get(index)
+        if label is None:
+            continue
+        ious.append(box.iou(label))
+        following = labels.get(index + 1)
+        if following is None or label.area() == 0 or following.area() == 0:
+            continue
+        motion = VMath.subtract(following.center(), label.center())
+        if VMath.norm(motion) < MIN_MOTION or VMath.norm(direction) == 0:
+            continue
+        errors.append(angle(direction, motion))
+    if len(ious) == 0:
+        raise Exception("no labelled frames")
+    ious = np.array(ious)
+    return {"frames": len(ious),
+            "iou": ious.mean(),
+            "hit_rate": (ious >= HIT_IOU).mean(),
+            "direction_frames": len(errors),
+            "direction_error": np.mean(errors) if errors else 0.}
+
+def evaluate(pipeline, frames, labels):
+    """
+    Runs the pipeline over the frames of a recording, and returns the score
+    of its results along with the mean and p90 latency of detect.
+    """
+    latencies = []
+    boxes = []
+    directions = []
+    for prev, current in zip(frames, frames[1:]):
+        time_start = time.time()
+        largest, direction, frame_out = pipeline.detect(prev, current)
+        latencies.append((time.time() - time_start) * 1000)
+        boxes.append(largest)
+        directions.append(direction)
+    report = score(boxes, directions, labels)
+    latencies = np.array(latencies)
+    report["mean_ms"] = latencies.mean()
+    report["p90_ms"] = np.percentile(latencies, 90)
+    return report
+
+def main(directory, **kwargs):
+    # Draft labels from a pipeline run, to be corrected by hand
+    if os.path.exists(labels_path(directory)):
+        print labels_path(directory) + " exists, not overwriting it"
+        return
+    frames = list(framestore.load(directory))
+    pipeline = Pipeline.create(**kwargs)
+    labels = {}
+    for index, (prev, current) in enumerate(zip(frames, frames[1:])):
+        largest, direction, frame_out = pipeline.detect(prev, current)
+        labels[index] = largest
+    save_labels(directory, labels)
+    print "wrote %d draft labels to %s" % (len(labels), labels_path(directory))
+
+if __name__ == "__main__":
+    Pipeline.parser.add_argument("--data", type=str, default="data/analysis",
+                                 dest="directory",
+                                 help="directory of recorded frames to label")
+    args = Pipeline.parser.parse_args()
+    main(**vars(args))
@@ -1,7 +1,12 @@
 import argparse
+import buffers
+import capture
 import cv2
 import detect
+import executor
 import numpy as np
+import profiling
+import stages
 
 FACE_CASCADE_NAME = "cascades/haarcascade_frontalface_alt.xml";
 HAND_CASCADE_NAME = "cascades/hand_front.xml"
@@ -11,14 +16,83 @@ FRAME_HEIGHT = 240
 
 QUIT_KEY = 'c'
 
+# Number of frames between profiling reports in main
+PROFILE_INTERVAL = 100
+
+# Stages of every type of pipeline. The stages are:
+#     faces: detect faces and remove them from the image.
+#     background: subtract away the background.
+#     window: use a simplified version of a Kalman Filter to estimate the
+#         bounding box of the hand. This assumes smooth motion of the hand.
+#     hands: find hands, within the bounding box if there is one.
+#     findfaces: find faces instead of hands.
+#     largest: pick the largest object found.
+#     flow: find the optical flow in the bounding box of the object.
+#     correct: correct the estimate of our Kalman Filter, using the measured
+#         location and overall velocity of the hand.
+PIPELINES = {
+    "full": ["faces", "background", "window", "hands", "largest", "flow", "correct"],
+    "simple": ["hands", "largest", "flow"],
+    "face": ["findfaces", "largest", "flow"],
+    "noface": ["faces", "hands", "largest", "flow"],
+    "nofacekalman": ["faces", "window", "hands", "largest", "flow", "correct"],
+    "screenshot": ["faces", "background", "window", "hands", "largest", "flow",
+                   "correct"],
+    "kalman": ["window", "hands", "largest", "flow", "correct"],
+    "nobg": ["background", "hands", "largest", "flow"],
+    "nobgkalman": ["background", "window", "hands", "largest", "flow", "correct"],
+    "nofacenobg": ["faces", "background", "hands", "largest", "flow"],
+}
+
+# Debug views of every type of pipeline, as (window title, FrameState key),
+# optionally followed by whether to only show the predicted window
+VIEWS = {
+    "screenshot": [("Original Detection", "original"),
+                   ("Removed Faces", "no_faces"),
+                   ("Removed Background", "foreground"),
+                   ("Kalman Filter", "foreground", True)],
+}
+
+# Types of pipelines that can be created
+PIPELINE_TYPES = ["full", "simple", "face", "noface", "nofacekalman",
+                  "screenshot", "kalman", "nobg", "nobgkalman", "nofacenobg"]
+
+# Cascades shared by every pipeline in this process
+CASCADES = detect.CascadeRegistry()
+
+def create_subtractor(bgmodel, nframes, threshold, bgalpha):
+    """ Creates the background subtractor for the chosen background model. """
+    if bgmodel == "history":
+        return detect.BGSubtractor(nframes, threshold=threshold)
+    elif bgmodel == "average":
+        return detect.RunningAverageSubtractor(nframes, alpha=bgalpha,
+                                               threshold=threshold)
+    else:
+        raise Exception("unsupported background model: " + bgmodel)
+
+def create_tracker(tracker, window_width, window_height, directionScale):
+    """ Creates the filter predicting the window to search for the hand in. """
+    if tracker == "simple":
+        return detect.SimpleKalman(FRAME_WIDTH, FRAME_HEIGHT,
+                                   window_width, window_height, scale=directionScale)
+    elif tracker == "kalman":
+        return detect.KalmanTracker(FRAME_WIDTH, FRAME_HEIGHT,
+                                    window_width, window_height,
+                                    scale=directionScale)
+    else:
+        raise Exception("unsupported tracker: " + tracker)
+
 class Pipeline(object):
-    """ Abstract Class for pipelines. """
+    """
+    Pipeline built from a declarative list of stages. Every stage reads the
+    intermediate results of the stages before it from a shared FrameState,
+    so adding a variant only requires a new entry in PIPELINES.
+    """
 
     """ Command line arguments for our pipelines """
     parser = argparse.ArgumentParser(description="Optical Flow on Hand Detection")
     parser.add_argument("-pl", "--pipeline", type=str, default="full",
-                        choices=["full", "simple", "face", "noface", "nofacekalman",
-                                 "screenshot", "kalman", "nobg", "nobgkalman", "nofacenobg"],
+                        choices=PIPELINE_TYPES,
                         dest="pipeline_type", help="type of pipeline to run")
     parser.add_argument("--face_cascade_name", type=str, dest="face_cascade_name",
                         help="face cascade file name")
@@ -28,489 +102,315 @@ class Pipeline(object):
                         help="haar scale factor for hand detection")
     parser.add_argument("--haarMinNeighbors", type=int, dest="haarMinNeighbors",
                         help="haar min neighbors for hand detection")
+    parser.add_argument("--coarseScale", type=float, dest="coarseScale",
+                        help="search full frames for hands coarse to fine, at this scale first")
+    parser.add_argument("--coarseMinNeighbors", type=int, dest="coarseMinNeighbors",
+                        help="haar min neighbors for the coarse hand search")
+    parser.add_argument("--trackInterval", type=int, dest="trackInterval",
+                        help="follow a detected hand by template matching, running the hand cascade every this many frames")
+    parser.add_argument("--trackThreshold", type=float, dest="trackThreshold",
+                        help="min template match score before the hand cascade runs again")
     parser.add_argument("--minDistThreshold", type=int,  dest="minDistThreshold",
                         help="min distance threshold for lucas-kanade")
     parser.add_argument("--maxDistThreshold", type=int, dest="maxDistThreshold",
                         help="max distance threshold for lucas-kanade")
+    parser.add_argument("--lkTrack", action="store_const", const=True,
+                        dest="lkTrack",
+                        help="carry tracked points forward between frames for lucas-kanade")
+    parser.add_argument("--lkMinFeatures", type=int, dest="lkMinFeatures",
+                        help="min tracked points before lucas-kanade finds new corners")
+    parser.add_argument("--motionGate", type=float, dest="motionGate",
+                        help="skip detection while the mean change between frames is below this")
+    parser.add_argument("--motionGateScale", type=float, dest="motionGateScale",
+                        help="downsampling of the frames compared by the motion gate")
+    parser.add_argument("--faceInterval", type=int, dest="faceInterval",
+                        help="run face detection every this many frames")
+    parser.add_argument("--faceMotion", type=float, dest="faceMotion",
+                        help="run face detection once the faces moved this many pixels since it last ran")
+    parser.add_argument("--faceNudge", action="store_const", const=True,
+                        dest="faceNudge",
+                        help="move carried faces by their optical flow between face detections")
+    parser.add_argument("--tracker", type=str, choices=["simple", "kalman"],
+                        dest="tracker",
+                        help="filter predicting the search window: simple or constant-velocity kalman")
     parser.add_argument("--window_width", type=int,  dest="window_width",
                         help="width of search window for simple kalman")
     parser.add_argument("--window_height", type=int, dest="window_height",
                         help="height of search window for simple kalman")
+    parser.add_argument("--window_margin", type=int, dest="window_margin",
+                        help="margin around the search window for hand detection")
     parser.add_argument("--nframes", type=int, dest="nframes",
                         help="number of frames to preserve for bg subtraction")
     parser.add_argument("--threshold", type=int, dest="threshold",
                         help="threshold for bg subtraction")
+    parser.add_argument("--bgmodel", type=str, choices=["history", "average"],
+                        dest="bgmodel",
+                        help="background model: frame history or running average")
+    parser.add_argument("--bgalpha", type=float, dest="bgalpha",
+                        help="weight of new frames in the running average background")
     parser.add_argument("--directionScale", type=float, dest="directionScale",
                         help="scale factor for overall direction, used in kalman")
+    parser.add_argument("--profile", action="store_const", const=True,
+                        dest="profile",
+                        help="record the wall time of every pipeline stage")
 
-    @staticmethod
-    def create(pipeline_type, **kwargs):
-        # Filter out kwargs
-        newkwargs = {}
-        for key in kwargs:
-            if kwargs[key] is not None:
-                newkwargs[key] = kwargs[key]
-
-        if pipeline_type == "full":
-            return FullPipeline(**newkwargs)
-        elif pipeline_type == "simple":
-            return SimplePipeline(**newkwargs)
-        elif pipeline_type == "face":
-            return FacePipeline(**newkwargs)
-        elif pipeline_type == "noface":
-            return NoFacePipeline(**newkwargs)
-        elif pipeline_type == "nofacekalman":
-            return NoFaceKalmanPipeline(**newkwargs)
-        elif pipeline_type == "screenshot":
-            return FullScreenshotPipeline(**newkwargs)
-        elif pipeline_type == "kalman":
-            return KalmanPipeline(**newkwargs)
-        elif pipeline_type == "nobg":
-            return NoBgPipeline(**newkwargs)
-        elif pipeline_type == "nobgkalman":
-            return NoBgKalmanPipeline(**newkwargs)
-        elif pipeline_type == "nofacenobg":
-            return NoFaceNoBgPipeline(**newkwargs)
-        else:
-            raise Exception("unsupported option: " + pipeline_type)
+    # Profiler recording the wall time of the stages
+    profiler = profiling.PROFILER
 
-    def detect(self, frame1, frame2):
-        """
-        All implementing classes must implement this method. Returns frame1,
-        annotated with the detected hand and optical flow, the overall
-        direction of the scene, and the largest bounding box.
-        """
-        raise Exception("Must subclass implement")
-
-class FullPipeline(Pipeline):
-    """
-    Includes the full pipeline. The stages are:
-        1. Detect faces and remove them from the image.
-        2. Subtract away the background.
-        3. Use a simplified version of a Kalman Filter to estimate the
-            bounding box of the hand. This assumes smooth motion of the
-            hand.
-        4. Find the largest hand in the bounding box.
-        5. Find the optical flow in the bounding box of the hand.
-        6. Correct our estimate of our Kalman Filter, using the measured
-            location and overall velocity of the hand.
-    """
-
-    def __init__(self, face_cascade_name=FACE_CASCADE_NAME,
+    def __init__(self, pipeline_type="full",
+                 face_cascade_name=FACE_CASCADE_NAME,
                  hand_cascade_name=HAND_CASCADE_NAME,
                  haarScaleFactor=1.1, haarMinNeighbors=60,
+                 coarseScale=None, coarseMinNeighbors=5,
+                 trackInterval=None, trackThreshold=0.6,
                  minDistThreshold=5, maxDistThreshold=50,
-                 window_width=100, window_height=180,
-                 threshold=20, nframes=20, directionScale=0.02):
-        self.face_cascade = detect.CascadeDetector(face_cascade_name)
-        self.hand_cascade = detect.CascadeDetector(hand_cascade_name)
-        self.optical = detect.LKOpticalFlow(min_threshold=minDistThreshold,
-                                            max_threshold=maxDistThreshold)
-        self.subtractor = detect.BGSubtractor(nframes, threshold=threshold)
-        self.kalman = detect.SimpleKalman(FRAME_WIDTH, FRAME_HEIGHT,
-                                          window_width, window_height, scale=directionScale)
-        self.haarScaleFactor = haarScaleFactor
-        self.haarMinNeighbors = haarMinNeighbors
-
-    def detect(self, frame1, frame2):
-        # Remove faces from the scene
-        faces = self.face_cascade.find(frame1, minNeighbors=2, minSize=(30,30))
-        no_faces = self.face_cascade.remove(frame1, faces)
-
-        # Remove background
-        foreground = self.subtractor.bgremove(no_faces)
-
-        # Look at the window provided by Kalman prediction
-        search_filtered = self.kalman.predict().filter(foreground)
-
-        # Detect hands in the scene with no faces
-        hands = self.hand_cascade.find(search_filtered,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        largest = self.hand_cascade.largest(frame1, hands, draw=True)
-        mask = largest.mask(frame1)
-
-        # Detect motion in the scene
-        direction, frame_out = self.optical.direction(frame1, frame2, mask=mask)
-
-        # Update Kalman
-        correction = self.kalman.correct(largest, direction)
-        correction.draw(frame_out, detect.Color.BLUE)
-        return largest, direction, frame_out
-
-class KalmanPipeline(Pipeline):
-    """
-    Runs only Kalman.
-    """
-
-    def __init__(self, hand_cascade_name=HAND_CASCADE_NAME,
-                 haarScaleFactor=1.1, haarMinNeighbors=60,
-                 minDistThreshold=5, maxDistThreshold=50,
-                 window_width=100, window_height=180,
+                 lkTrack=False, lkMinFeatures=20,
+                 motionGate=None, motionGateScale=0.25,
+                 faceInterval=1, faceMotion=None, faceNudge=False,
+                 tracker="simple", window_width=100, window_height=180, window_margin=10,
+                 threshold=20, nframes=20, bgmodel="history", bgalpha=0.05,
                  directionScale=0.02):
-        self.hand_cascade = detect.CascadeDetector(hand_cascade_name)
-        self.optical = detect.LKOpticalFlow(min_threshold=minDistThreshold,
-                                            max_threshold=maxDistThreshold)
-        self.kalman = detect.SimpleKalman(FRAME_WIDTH, FRAME_HEIGHT,
-                                          window_width, window_height, scale=directionScale)
+        """
+        Constructor. Builds the stages and views listed for pipeline_type in
+        PIPELINES and VIEWS. Stateful components are shared by the stages
+        that need them, e.g. the window and correct stages share one filter.
+        If motionGate is set, a gate stage runs first, and skips the other
+        stages while the frames barely change.
+        """
+        if pipeline_type not in PIPELINES:
+            raise Exception("unsupported option: " + pipeline_type)
+        self.name = pipeline_type
+        self.face_cascade_name = face_cascade_name
+        self.hand_cascade_name = hand_cascade_name
         self.haarScaleFactor = haarScaleFactor
         self.haarMinNeighbors = haarMinNeighbors
-
-    def detect(self, frame1, frame2):
-        # Look at the window provided by Kalman prediction
-        search_filtered = self.kalman.predict().filter(frame1)
-
-        # Detect hands in the scene with no faces
-        hands = self.hand_cascade.find(search_filtered,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        largest = self.hand_cascade.largest(frame1, hands, draw=True)
-        mask = largest.mask(frame1)
-
-        # Detect motion in the scene
-        direction, frame_out = self.optical.direction(frame1, frame2, mask=mask)
-
-        # Update Kalman
-        correction = self.kalman.correct(largest, direction)
-        correction.draw(frame_out, detect.Color.BLUE)
-        return largest, direction, frame_out
-
-class NoBgPipeline(Pipeline):
-
-    def __init__(self, hand_cascade_name=HAND_CASCADE_NAME,
-                 haarScaleFactor=1.1, haarMinNeighbors=60,
-                 minDistThreshold=5, maxDistThreshold=50,
-                 threshold=20, nframes=20):
-        self.hand_cascade = detect.CascadeDetector(hand_cascade_name)
+        self.window_margin = window_margin
+        self.coarseScale = coarseScale
+        self.coarseMinNeighbors = coarseMinNeighbors
+        self.trackInterval = trackInterval
+        self.trackThreshold = trackThreshold
+        self.motionGate = motionGate
+        self.motionGateScale = motionGateScale
+        self.faceInterval = faceInterval
+        self.faceMotion = faceMotion
+        self.faceNudge = faceNudge
         self.optical = detect.LKOpticalFlow(min_threshold=minDistThreshold,
-                                            max_threshold=maxDistThreshold)
-        self.subtractor = detect.BGSubtractor(nframes, threshold=threshold)
-        self.haarScaleFactor = haarScaleFactor
-        self.haarMinNeighbors = haarMinNeighbors
-
-    def detect(self, frame1, frame2):
-        # Remove background
-        foreground = self.subtractor.bgremove(frame1)
-
-        # Detect hands in the scene with no faces
-        hands = self.hand_cascade.find(foreground,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        largest = self.hand_cascade.largest(frame1, hands, draw=True)
-        mask = largest.mask(frame1)
+                                            max_threshold=maxDistThreshold,
+                                            track=lkTrack,
+                                            min_features=lkMinFeatures)
+        self.subtractor = create_subtractor(bgmodel, nframes, threshold, bgalpha)
+        self.kalman = create_tracker(tracker, window_width, window_height,
+                                     directionScale)
+        names = PIPELINES[pipeline_type]
+        if motionGate is not None:
+            names = ["gate"] + names
+        self.stages = [self.create_stage(name) for name in names]
+        self.views = [stages.View(*view) for view in VIEWS.get(pipeline_type, [])]
+
+        # Scratch images of the frames, reused across calls
+        self.buffers = buffers.BufferPool()
+
+        # Context of the last frame2, carried forward to the next call
+        self.next_context = None
+
+        # Intermediate results of the last call to detect
+        self.state = None
 
-        # Detect motion in the scene
-        direction, frame_out = self.optical.direction(frame1, frame2, mask=mask)
-        return largest, direction, frame_out
-
-class NoFaceNoBgPipeline(Pipeline):
-
-    def __init__(self, face_cascade_name=FACE_CASCADE_NAME,
-                 hand_cascade_name=HAND_CASCADE_NAME,
-                 haarScaleFactor=1.1, haarMinNeighbors=60,
-                 minDistThreshold=5, maxDistThreshold=50,
-                 threshold=20, nframes=20):
-        self.face_cascade = detect.CascadeDetector(face_cascade_name)
-        self.hand_cascade = detect.CascadeDetector(hand_cascade_name)
-        self.optical = detect.LKOpticalFlow(min_threshold=minDistThreshold,
-                                            max_threshold=maxDistThreshold)
-        self.subtractor = detect.BGSubtractor(nframes, threshold=threshold)
-        self.haarScaleFactor = haarScaleFactor
-        self.haarMinNeighbors = haarMinNeighbors
-
-    def detect(self, frame1, frame2):
-        # Remove faces from the scene
-        faces = self.face_cascade.find(frame1, minNeighbors=2, minSize=(30,30))
-        no_faces = self.face_cascade.remove(frame1, faces)
-
-        # Remove background
-        foreground = self.subtractor.bgremove(no_faces)
-
-        # Detect hands in the scene with no faces
-        hands = self.hand_cascade.find(foreground,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        largest = self.hand_cascade.largest(frame1, hands, draw=True)
-        mask = largest.mask(frame1)
-
-        # Detect motion in the scene
-        direction, frame_out = self.optical.direction(frame1, frame2, mask=mask)
-        return largest, direction, frame_out
-
-class NoBgKalmanPipeline(Pipeline):
-
-    def __init__(self, hand_cascade_name=HAND_CASCADE_NAME,
-                 haarScaleFactor=1.1, haarMinNeighbors=60,
-                 minDistThreshold=5, maxDistThreshold=50,
-                 threshold=20, nframes=20,
-                 window_width=100, window_height=180,
-                 directionScale=0.02):
-        self.hand_cascade = detect.CascadeDetector(hand_cascade_name)
-        self.optical = detect.LKOpticalFlow(min_threshold=minDistThreshold,
-                                            max_threshold=maxDistThreshold)
-        self.subtractor = detect.BGSubtractor(nframes, threshold=threshold)
-        self.kalman = detect.SimpleKalman(FRAME_WIDTH, FRAME_HEIGHT,
-                                          window_width, window_height, scale=directionScale)
-        self.haarScaleFactor = haarScaleFactor
-        self.haarMinNeighbors = haarMinNeighbors
-
-    def detect(self, frame1, frame2):
-        # Remove background
-        foreground = self.subtractor.bgremove(frame1)
-
-        # Look at the window provided by Kalman prediction
-        search_filtered = self.kalman.predict().filter(foreground)
-
-        # Detect hands in the scene with no faces
-        hands = self.hand_cascade.find(search_filtered,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        largest = self.hand_cascade.largest(frame1, hands, draw=True)
-        mask = largest.mask(frame1)
-
-        # Detect motion in the scene
-        direction, frame_out = self.optical.direction(frame1, frame2, mask=mask)
-
-        # Update Kalman
-        correction = self.kalman.correct(largest, direction)
-        correction.draw(frame_out, detect.Color.BLUE)
-        return largest, direction, frame_out
-
-class NoFaceKalmanPipeline(Pipeline):
-
-    def __init__(self, face_cascade_name=FACE_CASCADE_NAME,
-                 hand_cascade_name=HAND_CASCADE_NAME,
-                 haarScaleFactor=1.1, haarMinNeighbors=60,
-                 minDistThreshold=5, maxDistThreshold=50,
-                 window_width=100, window_height=180,
-                 directionScale=0.02):
-        self.face_cascade = detect.CascadeDetector(face_cascade_name)
-        self.hand_cascade = detect.CascadeDetector(hand_cascade_name)
-        self.optical = detect.LKOpticalFlow(min_threshold=minDistThreshold,
-                                            max_threshold=maxDistThreshold)
-        self.kalman = detect.SimpleKalman(FRAME_WIDTH, FRAME_HEIGHT,
-                                          window_width, window_height, scale=directionScale)
-        self.haarScaleFactor = haarScaleFactor
-        self.haarMinNeighbors = haarMinNeighbors
+    @staticmethod
+    def create(pipeline_type, profile=None, **kwargs):
+        if profile:
+            profiling.PROFILER.enable()
 
-    def detect(self, frame1, frame2):
-        # Remove faces from the scene
-        faces = self.face_cascade.find(frame1, minNeighbors=2, minSize=(30,30))
-        no_faces = self.face_cascade.remove(frame1, faces)
-
-        # Look at the window provided by Kalman prediction
-        search_filtered = self.kalman.predict().filter(no_faces)
-
-        # Detect hands in the scene with no faces
-        hands = self.hand_cascade.find(search_filtered,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        largest = self.hand_cascade.largest(frame1, hands, draw=True)
-        mask = largest.mask(frame1)
-
-        # Detect motion in the scene
-        direction, frame_out = self.optical.direction(frame1, frame2, mask=mask)
-
-        # Update Kalman
-        correction = self.kalman.correct(largest, direction)
-        correction.draw(frame_out, detect.Color.BLUE)
-        return largest, direction, frame_out
-
-class NoFacePipeline(Pipeline):
-    """
-    Hand detection by only removing faces.
-    """
-    def __init__(self, face_cascade_name=FACE_CASCADE_NAME,
-                 hand_cascade_name=HAND_CASCADE_NAME,
-                 haarScaleFactor=1.1, haarMinNeighbors=60,
-                 minDistThreshold=5, maxDistThreshold=50):
-        self.face_cascade = detect.CascadeDetector(face_cascade_name)
-        self.hand_cascade = detect.CascadeDetector(hand_cascade_name)
-        self.optical = detect.LKOpticalFlow(min_threshold=minDistThreshold,
-                                            max_threshold=maxDistThreshold)
-        self.haarScaleFactor = haarScaleFactor
-        self.haarMinNeighbors = haarMinNeighbors
+        # Filter out kwargs
+        newkwargs = {}
+        for key in kwargs:
+            if kwargs[key] is not None:
+                newkwargs[key] = kwargs[key]
+        return Pipeline(pipeline_type, **newkwargs)
+
+    def create_stage(self, name):
+        """ Creates the stage with the given name in PIPELINES. """
+        if name == "gate":
+            return stages.MotionGate(self.motionGate, scale=self.motionGateScale)
+        elif name == "faces":
+            return stages.RemoveFaces(CASCADES.get(self.face_cascade_name),
+                                      interval=self.faceInterval,
+                                      motion_threshold=self.faceMotion,
+                                      nudge=self.faceNudge)
+        elif name == "background":
+            return stages.RemoveBackground(self.subtractor)
+        elif name == "window":
+            return stages.PredictWindow(self.kalman)
+        elif name == "hands":
+            return stages.FindHands(CASCADES.get(self.hand_cascade_name),
+                                    scaleFactor=self.haarScaleFactor,
+                                    minNeighbors=self.haarMinNeighbors,
+                                    margin=self.window_margin,
+                                    coarse_scale=self.coarseScale,
+                                    coarse_min_neighbors=self.coarseMinNeighbors,
+                                    track_interval=self.trackInterval,
+                                    track_threshold=self.trackThreshold)
+        elif name == "findfaces":
+            return stages.FindFaces(CASCADES.get(self.face_cascade_name))
+        elif name == "largest":
+            return stages.Largest()
+        elif name == "flow":
+            return stages.OpticalFlow(self.optical)
+        elif name == "correct":
+            return stages.CorrectWindow(self.kalman)
+        else:
+            raise Exception("unsupported stage: " + name)
 
-    def detect(self, frame1, frame2):
-        # Remove faces from the scene
-        faces = self.face_cascade.find(frame1, minNeighbors=2, minSize=(30,30))
-        no_faces = self.face_cascade.remove(frame1, faces)
-
-        # Detect hands in the scene with no faces
-        hands = self.hand_cascade.find(no_faces,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        largest = self.hand_cascade.largest(frame1, hands, draw=True)
-        mask = largest.mask(frame1)
-
-        # Detect motion in the scene
-        direction, frame_out = self.optical.direction(frame1, frame2, mask=mask)
-        return largest, direction, frame_out
-
-class SimplePipeline(Pipeline):
-    """
-    Simple pipeline that detects hands without preprocessing.
-    """
+    def contexts(self, frame1, frame2):
+        """
+        Returns the FrameContexts of a pair of frames. When frame1 is the
+        frame2 of the previous call, its context is carried forward, so its
+        derived images are not computed again.
+        """
+        if self.next_context is not None and self.next_context.frame is frame1:
+            context1 = self.next_context
+        else:
+            if self.next_context is not None:
+                self.drop(self.next_context)
+            context1 = detect.FrameContext(frame1, self.buffers)
+        self.next_context = detect.FrameContext(frame2, self.buffers)
+        return context1, self.next_context
 
-    def __init__(self, hand_cascade_name=HAND_CASCADE_NAME,
-                 minDistThreshold=5, maxDistThreshold=50,
-                 haarScaleFactor=1.1, haarMinNeighbors=60):
-        self.hand_cascade = detect.CascadeDetector(hand_cascade_name)
-        self.haarScaleFactor = haarScaleFactor
-        self.haarMinNeighbors = haarMinNeighbors
-        self.optical = detect.LKOpticalFlow(min_threshold=minDistThreshold,
-                                            max_threshold=maxDistThreshold)
+    def drop(self, context):
+        """
+        Releases a second frame's context that is not carried forward, now
+        if its call already finished, otherwise once it does.
+        """
+        context.dropped = True
+        if context.finished:
+            context.release()
 
     def detect(self, frame1, frame2):
-        # Detect hands in the scene with no faces
-        hands = self.hand_cascade.find(frame1,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        largest = self.hand_cascade.largest(frame1, hands, draw=True)
-        mask = largest.mask(frame1)
-
-        # Detect motion in the scene
-        direction, frame_out = self.optical.direction(frame1, frame2, mask=mask)
-        return largest, direction, frame_out
-
-class FacePipeline(Pipeline):
-    """
-    Simple pipeline for face detection.
-    """
-
-    def __init__(self, face_cascade_name=FACE_CASCADE_NAME,
-                 minDistThreshold=5, maxDistThreshold=50):
-        self.face_cascade = detect.CascadeDetector(face_cascade_name)
-        self.optical = detect.LKOpticalFlow(min_threshold=minDistThreshold,
-                                            max_threshold=maxDistThreshold)
+        """
+        Runs the stages of the pipeline on a pair of frames, then renders
+        the debug views. Returns the largest bounding box, the overall
+        direction of the scene, and frame1 annotated with the detected hand
+        and optical flow.
+        """
+        state = self.begin(frame1, frame2)
+        try:
+            self.run(state, self.stages)
+            return self.finish(state)
+        finally:
+            # Once finished this does nothing, but a failed stage skips finish
+            self.release(state)
+
+    def begin(self, frame1, frame2):
+        """ Returns the FrameState for a new pair of frames. """
+        context1, context2 = self.contexts(frame1, frame2)
+        return stages.FrameState(context1, context2,
+                                 keep_original=len(self.views) > 0,
+                                 pool=self.buffers)
+
+    def run(self, state, segment):
+        """ Runs a list of stages on the state, until one sets state.done. """
+        for stage in segment:
+            if state.done:
+                break
+            with self.profiler.stage(stage.name):
+                stage.run(state)
+
+    def finish(self, state):
+        """
+        Completes the state once all its stages ran, in the order the frames
+        were begun, then renders the debug views and releases the scratch
+        images of the call. Returns the same as detect.
+        """
+        try:
+            if state.gated and self.state is not None:
+                state.reuse(self.state)
+            for view in self.views:
+                view.render(state)
+        finally:
+            self.release(state)
+        self.state = state
+        return state.largest, state.direction, state.frame
+
+    def release(self, state):
+        """
+        Releases the scratch images of a call, whether or not its stages all
+        ran. Releasing a state again does nothing.
+        """
+        state.release()
 
-    def detect(self, frame1, frame2):
-        faces = self.face_cascade.find(frame1, scaleFactor=1.1, minNeighbors=2,
-                                       minSize=(30,30))
-        largest = self.face_cascade.largest(frame1, faces, draw=True)
-        mask = largest.mask(frame1)
-        direction, frame_out = self.optical.direction(frame1, frame2, mask=mask)
-        return largest, direction, frame_out
-
-class FullScreenshotPipeline(Pipeline):
-    """
-    Includes the full pipeline and creates different windows to see intermediate results.
-    """
+        # No later call uses the first frame, and the second frame only if
+        # it is carried forward
+        state.context1.release()
+        state.context2.finished = True
+        if state.context2.dropped:
+            state.context2.release()
 
-    def __init__(self, face_cascade_name=FACE_CASCADE_NAME,
-                 hand_cascade_name=HAND_CASCADE_NAME,
-                 haarScaleFactor=1.1, haarMinNeighbors=60,
-                 minDistThreshold=5, maxDistThreshold=50,
-                 window_width=100, window_height=180,
-                 threshold=20, nframes=20, directionScale=0.02):
-        self.face_cascade = detect.CascadeDetector(face_cascade_name)
-        self.hand_cascade = detect.CascadeDetector(hand_cascade_name)
-        self.optical = detect.LKOpticalFlow(min_threshold=minDistThreshold,
-                                            max_threshold=maxDistThreshold)
-        self.subtractor = detect.BGSubtractor(nframes, threshold=threshold)
-        self.kalman = detect.SimpleKalman(FRAME_WIDTH, FRAME_HEIGHT,
-                                          window_width, window_height, scale=directionScale)
-        self.haarScaleFactor = haarScaleFactor
-        self.haarMinNeighbors = haarMinNeighbors
+    def stats(self):
+        """
+        Returns the counters of every stage that reports any, and of the
+        buffer pool.
+        """
+        stats = dict((stage.name, stage.stats()) for stage in self.stages
+                     if stage.stats())
+        stats["buffers"] = self.buffers.stats()
+        return stats
 
-    def detect(self, frame1, frame2):
-        # Show original detection
-        frame1_copy = frame1.copy()
-        hands = self.hand_cascade.find(frame1_copy,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        self.hand_cascade.largest(frame1_copy, hands, draw=True)
-        cv2.imshow("Original Detection", frame1_copy)
-
-        # Remove faces from the scene
-        faces = self.face_cascade.find(frame1, minNeighbors=2, minSize=(30,30))
-        no_faces = self.face_cascade.remove(frame1, faces)
-        hands = self.hand_cascade.find(no_faces,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        no_faces_copy = no_faces.copy()
-        self.hand_cascade.largest(no_faces_copy, hands, draw=True)
-        cv2.imshow("Removed Faces", no_faces_copy)
-
-        # Remove background
-        foreground = self.subtractor.bgremove(no_faces)
-        hands = self.hand_cascade.find(foreground,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        foreground_copy = foreground.copy()
-        self.hand_cascade.largest(foreground_copy, hands, draw=True)
-        cv2.imshow("Removed Background", foreground_copy)
-
-        # Look at the window provided by Kalman prediction
-        search_filtered = self.kalman.predict().filter(foreground)
-        hands = self.hand_cascade.find(search_filtered,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        search_filtered_copy = search_filtered.copy()
-        self.hand_cascade.largest(search_filtered_copy, hands, draw=True)
-        cv2.imshow("Kalman Filter", search_filtered_copy)
-
-        # Detect hands in the scene with no faces
-        hands = self.hand_cascade.find(search_filtered,
-                                       scaleFactor=self.haarScaleFactor,
-                                       minNeighbors=self.haarMinNeighbors,
-                                       minSize=(25,35))
-        largest = self.hand_cascade.largest(frame1, hands, draw=True)
-        mask = largest.mask(frame1)
-
-        # Detect motion in the scene
-        direction, frame_out = self.optical.direction(frame1, frame2, mask=mask)
-
-        # Update Kalman
-        correction = self.kalman.correct(largest, direction)
-        correction.draw(frame_out, detect.Color.BLUE)
-        return largest, direction, frame_out
-
-def main(**kwargs):
+def main(captureBuffer=4, pipelined=None, **kwargs):
     # Read video stream from webcam
-    capture = cv2.VideoCapture(0)
-    if not capture.isOpened():
+    webcam = cv2.VideoCapture(0)
+    if not webcam.isOpened():
         print "couldn't load webcam"
         return
-    capture.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
-    capture.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
+    webcam.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
+    webcam.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
 
     # Create pipeline from command line arguments
     pipeline = Pipeline.create(**kwargs)
 
-    while True:
-        retval1, frame1 = capture.read()
-        retval2, frame2 = capture.read()
-        if not retval1 or not retval2:
-            print "could not grab frames"
-            return
+    # Overlap the stages of up to `pipelined` frames at once
+    runner = None
+    if pipelined:
+        runner = executor.PipelinedExecutor(pipeline)
 
-        # Mirror the frames to mimic webcam motion
-        frame1 = cv2.flip(frame1, 1)
-        frame2 = cv2.flip(frame2, 1)
+    # Read frames on a background thread, while we detect
+    reader = capture.CaptureThread(webcam, size=captureBuffer)
+    reader.start()
 
+    count = 0
+    for frame1, frame2 in reader.pairs():
         # Detect hand and direction of the scene
-        largest, direction, frame_out = pipeline.detect(frame1, frame2)
-        print(direction)
+        if runner is None:
+            largest, direction, frame_out = pipeline.detect(frame1, frame2)
+        else:
+            runner.submit(frame1, frame2)
+            if runner.pending < pipelined:
+                continue
+            largest, direction, frame_out = runner.result()
+        stats = reader.stats()
+        print direction, "dropped=%d depth=%d" % (stats["dropped"], stats["depth"])
+        count += 1
+        if pipeline.profiler.enabled and count % PROFILE_INTERVAL == 0:
+            print(pipeline.profiler.report())
+            print(pipeline.stats())
+            print(stats)
         cv2.imshow(WINDOW_NAME, frame_out)
 
         # Handlers for key presses
         c = cv2.waitKey(10)
         if chr(c & 255) is QUIT_KEY:
             break
+    else:
+        print "could not grab frames"
+    if runner is not None:
+        runner.close()
+    reader.stop()
+    print(reader.stats())
 
 if __name__ == "__main__":
+    Pipeline.parser.add_argument("--captureBuffer", type=int, default=4,
+                                 dest="captureBuffer",
+                                 help="max frames captured ahead of detection")
+    Pipeline.parser.add_argument("--pipelined", type=int, dest="pipelined",
+                                 help="overlap the stages of up to this many frames, on a thread per stage")
     args = Pipeline.parser.parse_args()
     main(**vars(args))
@@ -0,0 +1,111 @@
+import collections
+import numpy as np
+import time
+
+# Percentiles reported for every stage
+PERCENTILES = [50, 90, 99]
+
+class NullTimer(object):
+    """ Timer handed out while profiling is disabled. Does nothing. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class StageTimer(object):
+    """ Context manager recording the wall time of one stage. """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name, time.time() - self.start)
+        return False
+
+class StageProfiler(object):
+    """
+    Records the wall time of pipeline stages into rolling histograms, which
+    keep the last window samples of every stage. Stages are timed with:
+
+        with profiler.stage("name"):
+            ...
+
+    While disabled, stage returns a shared timer that does nothing, so the
+    instrumentation costs about a method call. Profiling can be switched on
+    and off at any time.
+    """
+
+    def __init__(self, window=1000, enabled=False):
+        self.window = window
+        self.enabled = enabled
+        self.samples = collections.OrderedDict()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.samples.clear()
+
+    def stage(self, name):
+        """ Returns a context manager timing the stage with the given name. """
+        if not self.enabled:
+            return NULL_TIMER
+        return StageTimer(self, name)
+
+    def record(self, name, seconds):
+        """ Adds a sample of the stage, dropping its oldest sample if needed. """
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = collections.deque(maxlen=self.window)
+            self.samples[name] = samples
+        samples.append(seconds)
+
+    def histogram(self, name, bins=10):
+        """
+        Returns the histogram (counts, bin edges in milliseconds) of the
+        samples of the stage.
+        """
+        return np.histogram(np.array(self.samples[name]) * 1000, bins=bins)
+
+    def summary(self):
+        """
+        Returns a dictionary of stage name to the sample count, the mean,
+        max and percentiles of its wall time in milliseconds.
+        """
+        summary = collections.OrderedDict()
+        for name in self.samples:
+            samples = np.array(self.samples[name]) * 1000
+            if len(samples) == 0:
+                continue
+            stats = {"count": len(samples),
+                     "mean_ms": samples.mean(),
+                     "max_ms": samples.max()}
+            for p in PERCENTILES:
+                stats["p%d_ms" % p] = np.percentile(samples, p)
+            summary[name] = stats
+        return summary
+
+    def report(self):
+        """ Returns the summary formatted as a table. """
+        lines = ["%-16s %6s %8s %8s %8s %8s" % ("stage", "count", "mean_ms",
+                                               "p50_ms", "p90_ms", "p99_ms")]
+        for name, stats in self.summary().items():
+            lines.append("%-16s %6d %8.2f %8.2f %8.2f %8.2f" % (
+                name, stats["count"], stats["mean_ms"], stats["p50_ms"],
+                stats["p90_ms"], stats["p99_ms"]))
+        return "\n".join(lines)
+
+# Profiler shared by every pipeline in this process
+PROFILER = StageProfiler()
@@ -1,4 +1,6 @@
 import cv2
+import framestore
+import os
 import pipeline
 
 # Number of frames to record
@@ -13,6 +15,11 @@ def main():
     capture.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, pipeline.FRAME_WIDTH)
     capture.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, pipeline.FRAME_HEIGHT)
 
+    # Raw frames, replayed without decoding by analyze.py and benchmark.py.
+    # The webcam may not honor the requested size, so the store is sized
+    # from the first frame it grabs.
+    writer = None
+
     prev = None
     current = None
 
@@ -21,7 +28,10 @@ def main():
         retval1, current = capture.read()
         if not retval1:
             print "could not grab frame"
-            return
+            break
+        if writer is None:
+            writer = framestore.FrameWriter(os.path.join("data/analysis", framestore.FRAMES_NAME),
+                                            current.shape, NUM_FRAMES)
         if prev is None:
             continue
 
@@ -29,7 +39,10 @@ def main():
         prev = cv2.flip(prev, 1)
 
         # Write frame to disk
+        writer.write(prev)
         cv2.imwrite("data/analysis/img%04d.jpg" % i, prev)
+    if writer is not None:
+        writer.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
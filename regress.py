@@ -0,0 +1,151 @@
+import framestore
+import groundtruth
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+from benchmark import INTERACTIVE_TYPES
+from pipeline import Pipeline, PIPELINE_TYPES
+
+# Accuracy baselines of every pipeline type, by recording. Latencies depend
+# on the machine, so their baselines are kept apart and not committed.
+BASELINES_NAME = "data/baselines.json"
+LATENCY_BASELINES_NAME = "data/latency.json"
+
+# Metrics stored in each file
+ACCURACY_METRICS = ["frames", "iou", "hit_rate", "direction_frames",
+                    "direction_error"]
+LATENCY_METRICS = ["mean_ms", "p90_ms"]
+
+# How far each metric may move from its baseline before the check fails:
+# latencies may grow by this fraction, scores may drop by this much, and
+# the direction error may grow by this many degrees
+TOLERANCES = {
+    "mean_ms": 0.25,
+    "iou": 0.05,
+    "hit_rate": 0.05,
+    "direction_error": 10.,
+}
+
+def evaluate(pipeline_type, directory, kwargs):
+    """ Scores one type of pipeline against the labels of a recording. """
+    try:
+        frames = list(framestore.load(directory))
+        labels = groundtruth.load_labels(directory)
+        pipeline = Pipeline.create(pipeline_type, **kwargs)
+        return pipeline_type, groundtruth.evaluate(pipeline, frames, labels)
+    except Exception:
+        return pipeline_type, {"error": traceback.format_exc()}
+
+def _evaluate(args):
+    return evaluate(*args)
+
+def check(report, baseline, latency_baseline, latency_tolerance):
+    """
+    Compares a report to its accuracy baseline, and to its latency baseline
+    unless it is None. Returns a list describing every metric outside its
+    tolerance, empty if the report passes.
+    """
+    failures = []
+    if latency_baseline is not None:
+        limit = latency_baseline["mean_ms"] * (1 + latency_tolerance)
+        if report["mean_ms"] > limit:
+            failures.append("mean_ms %.2f > %.2f" % (report["mean_ms"], limit))
+    for metric in ["iou", "hit_rate"]:
+        limit = baseline[metric] - TOLERANCES[metric]
+        if report[metric] < limit:
+            failures.append("%s %.3f < %.3f" % (metric, report[metric], limit))
+    limit = baseline["direction_error"] + TOLERANCES["direction_error"]
+    if report["direction_error"] > limit:
+        failures.append("direction_error %.1f > %.1f" % (report["direction_error"], limit))
+    return failures
+
+def load_baselines(path):
+    """ Returns the baselines stored in path, by recording and pipeline type. """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_baselines(path, stored, directory, results, metrics):
+    """ Stores the given metrics of the reports as the baselines in path. """
+    stored.setdefault(directory, {}).update(
+        (pipeline_type, dict((metric, report[metric]) for metric in metrics))
+        for pipeline_type, report in results if "error" not in report)
+    with open(path, "w") as f:
+        json.dump(stored, f, indent=2, sort_keys=True, separators=(",", ": "))
+    print "wrote baselines to " + path
+
+def main(types, directory, baselines, latency_baselines, update, processes,
+         latency_tolerance, **kwargs):
+    kwargs.pop("pipeline_type", None)
+    kwargs.pop("profile", None)
+    if not os.path.exists(groundtruth.labels_path(directory)):
+        print "no labels in %s, run groundtruth.py --data=%s first" % (directory, directory)
+        return 1
+    stored = load_baselines(baselines)
+    stored_latency = load_baselines(latency_baselines)
+
+    pool = multiprocessing.Pool(processes)
+    results = pool.map(_evaluate, [(pipeline_type, directory, kwargs)
+                                   for pipeline_type in types])
+    pool.close()
+
+    failed = 0
+    print "%-12s %8s %6s %8s %8s  %s" % ("pipeline", "mean_ms", "iou",
+                                         "hit_rate", "dir_err", "result")
+    for pipeline_type, report in results:
+        if "error" in report:
+            print "%-12s failed:\n%s" % (pipeline_type, report["error"])
+            failed += 1
+            continue
+        baseline = stored.get(directory, {}).get(pipeline_type)
+        latency_baseline = stored_latency.get(directory, {}).get(pipeline_type)
+        if update:
+            result = "updated"
+        elif baseline is None:
+            result = "no baseline, run with --update"
+            failed += 1
+        else:
+            failures = check(report, baseline, latency_baseline,
+                             latency_tolerance)
+            result = "; ".join(failures) if failures else "ok"
+            failed += len(failures) > 0
+        print "%-12s %8.2f %6.3f %8.3f %8.1f  %s" % (
+            pipeline_type, report["mean_ms"], report["iou"], report["hit_rate"],
+            report["direction_error"], result)
+
+    if update:
+        save_baselines(baselines, stored, directory, results, ACCURACY_METRICS)
+        save_baselines(latency_baselines, stored_latency, directory, results,
+                       LATENCY_METRICS)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    Pipeline.parser.add_argument("--types", type=str, nargs="+",
+                                 choices=PIPELINE_TYPES, dest="types",
+                                 default=[t for t in PIPELINE_TYPES
+                                          if t not in INTERACTIVE_TYPES],
+                                 help="types of pipelines to check")
+    Pipeline.parser.add_argument("--data", type=str, default="data/analysis",
+                                 dest="directory",
+                                 help="directory of labelled recorded frames")
+    Pipeline.parser.add_argument("--baselines", type=str, default=BASELINES_NAME,
+                                 dest="baselines",
+                                 help="json file holding the accuracy baselines")
+    Pipeline.parser.add_argument("--latencyBaselines", type=str,
+                                 default=LATENCY_BASELINES_NAME,
+                                 dest="latency_baselines",
+                                 help="json file holding the latency baselines of this machine")
+    Pipeline.parser.add_argument("--update", action="store_true", dest="update",
+                                 help="store the results as the new baselines")
+    Pipeline.parser.add_argument("--processes", type=int, default=1,
+                                 dest="processes",
+                                 help="number of pipelines to run at once")
+    Pipeline.parser.add_argument("--latencyTolerance", type=float,
+                                 default=TOLERANCES["mean_ms"],
+                                 dest="latency_tolerance",
+                                 help="fraction by which latency may exceed its baseline")
+    args = Pipeline.parser.parse_args()
+    sys.exit(main(**vars(args)))
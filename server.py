@@ -1,17 +1,46 @@
-import base64
-import cv2
+import codec
+import multiprocessing
 import os
 import pipeline
 import threading
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 import tornado.websocket
+import workers
 
-# Directory for temporary files
-DIRECTORY = os.path.join(os.path.dirname(__file__), "tmp")
+# Workers running the pipelines of this server
+WORKERS = None
 
-# Pipeline to run on this server
-PIPELINE = None
+# Maximum number of frames waiting per session
+MAX_PENDING = 1
+
+# Replies sent to clients that don't choose their own: mode, image format
+# and image quality
+REPLY_MODE = "image"
+IMAGE_FORMAT = "png"
+IMAGE_QUALITY = None
+
+# Image formats clients may ask replies to be encoded in
+IMAGE_FORMATS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+
+def parse_reply(mode, image_format, quality):
+    """
+    Returns the reply for workers._detect, given the reply mode ("image" or
+    "geometry"), image format (a key of IMAGE_FORMATS) and quality (0-100,
+    or None for the encoder's default).
+    """
+    if mode == "geometry":
+        return ("geometry",)
+    elif mode == "image":
+        if image_format not in IMAGE_FORMATS:
+            raise Exception("unsupported image format: " + image_format)
+        return ("image", IMAGE_FORMATS[image_format],
+                None if quality is None else int(quality))
+    else:
+        raise Exception("unsupported reply: " + mode)
 
 def serialize_direction((x,y)):
     """
@@ -31,53 +60,85 @@ class MainHandler(tornado.web.RequestHandler):
     def get(self):
         self.render("index.html")
 
+class StatsHandler(tornado.web.RequestHandler):
+    """
+    Returns the frame counters of every open session as json, along with
+    the counters of its pipeline as of its last processed frame, such as the
+    hit rate of the motion gate. With several server processes, only the
+    sessions of the process that accepted the request are listed.
+    """
+    def get(self):
+        sessions = VideoWebSocketHandler.sessions
+        self.write(dict((str(id), dict(sessions[id].scheduler.stats(),
+                                       pipeline=sessions[id].pipeline_stats))
+                        for id in sessions))
+
 class VideoWebSocketHandler(tornado.websocket.WebSocketHandler):
     """
     Creates a web socket connection to the client for receiving frames
     and sending back the annotated frame and overall motion of the scene.
+    Clients may choose the replies of their session with the query
+    arguments reply=image|geometry, format=png|jpeg|webp and quality=0-100.
+    Geometry replies only hold the overlay (see codec.encode_geometry), for
+    clients that draw it on their own copy of the frame.
     """
 
     # Create a unique id per websocket
     id = 0
     lock = threading.Lock()
 
+    # Open websockets by id
+    sessions = {}
+
     def open(self):
         with self.__class__.lock:
             self.__class__.id += 1
             self.id = self.__class__.id
-        self.file_in = DIRECTORY + "/in" + str(self.id) + ".jpeg"
-        self.file_out = DIRECTORY + "/out" + str(self.id) + ".png"
-        self.prev = None
-        if not os.path.exists(DIRECTORY):
-            os.makedirs(DIRECTORY)
-        print "Websocket " + str(self.id) + " opened"
+        self.active = True
+        self.pipeline_stats = {}
+        try:
+            self.reply = parse_reply(self.get_argument("reply", REPLY_MODE),
+                                     self.get_argument("format", IMAGE_FORMAT),
+                                     self.get_argument("quality", IMAGE_QUALITY))
+        except Exception as e:
+            print "Websocket " + str(self.id) + " using default replies: " + str(e)
+            self.reply = parse_reply(REPLY_MODE, IMAGE_FORMAT, IMAGE_QUALITY)
+        self.worker = WORKERS.assign()
+        self.scheduler = workers.FrameScheduler(WORKERS, self.worker, self.id,
+                                                self.on_detect,
+                                                max_pending=MAX_PENDING,
+                                                reply=self.reply)
+        self.__class__.sessions[self.id] = self
+        print "Websocket " + str(self.id) + " opened on worker " + str(self.worker)
 
     def on_message(self, message):
-        newim = self.parse_image(message)
-        if self.prev == None:
-            self.prev = newim
+        # Frames arrive either as raw binary or as base64 encoded text
+        newim = codec.decode_frame(message)
+        if newim is None:
+            print "Websocket " + str(self.id) + " received an invalid frame"
+            return
+
+        # Run detection on this session's worker, off the IOLoop
+        self.scheduler.push(newim)
+
+    def on_detect(self, error, result):
+        if error is not None:
+            print "Websocket " + str(self.id) + " failed to detect:\n" + error
+            return
+        if not self.active:
+            return
+        direction, payload, self.pipeline_stats = result
+        if self.reply[0] == "geometry":
+            self.write_message(payload, binary=True)
         else:
-            largest, direction, retim = PIPELINE.detect(self.prev, newim)
-            cv2.imwrite(self.file_out, retim)
-            self.prev = newim
-            file = open(self.file_out, "r")
-            self.write_message(serialize_direction(direction) + str(file.read()),
-                               binary=True)
-            file.close()
+            self.write_message(serialize_direction(direction) + payload, binary=True)
 
     def on_close(self):
-        if os.path.isfile(self.file_in):
-            os.remove(self.file_in)
-        if os.path.isfile(self.file_out):
-            os.remove(self.file_out)
-        print "Websocket " + str(self.id) + " closed"
-
-    def parse_image(self, buf):
-        img_str = base64.b64decode(buf)
-        img = open(self.file_in, "w+");
-        img.write(base64.b64decode(buf))
-        img.close()
-        return cv2.imread(self.file_in)
+        self.active = False
+        self.scheduler.close()
+        WORKERS.release(self.worker, self.id)
+        del self.__class__.sessions[self.id]
+        print "Websocket " + str(self.id) + " closed " + str(self.scheduler.stats())
 
 settings = {
     "static_path": os.path.join(os.path.dirname(__file__), "static"),
@@ -86,6 +147,7 @@ settings = {
 application = tornado.web.Application([
     (r"/", MainHandler),
     (r"/websocket", VideoWebSocketHandler),
+    (r"/stats", StatsHandler),
     (r"/static", tornado.web.StaticFileHandler, dict(path=settings['static_path'])),
 ], **settings)
 
@@ -93,9 +155,65 @@ if __name__ == "__main__":
     pipeline.Pipeline.parser.add_argument("-p", "--port", type=int,
                                           default=8888, dest="port",
                                           help="port to listen to")
+    pipeline.Pipeline.parser.add_argument("--executor", type=str, default="thread",
+                                          choices=["thread", "process", "pipelined"],
+                                          dest="executor",
+                                          help="workers to run detection on, or overlapping stages per session")
+    pipeline.Pipeline.parser.add_argument("--workers", type=int,
+                                          dest="workers",
+                                          help="number of detection workers per server process, or sessions with overlapping stages")
+    pipeline.Pipeline.parser.add_argument("--processes", type=int, default=1,
+                                          dest="processes",
+                                          help="number of server processes sharing the port, 0 for one per core")
+    pipeline.Pipeline.parser.add_argument("--inflight", type=int, default=3,
+                                          dest="inflight",
+                                          help="frames per session whose stages overlap, with --executor=pipelined")
+    pipeline.Pipeline.parser.add_argument("--maxPending", type=int, default=1,
+                                          dest="max_pending",
+                                          help="max frames waiting per session")
+    pipeline.Pipeline.parser.add_argument("--reply", type=str, default="image",
+                                          choices=["image", "geometry"],
+                                          dest="reply",
+                                          help="default reply: annotated frame or overlay geometry")
+    pipeline.Pipeline.parser.add_argument("--imageFormat", type=str, default="png",
+                                          choices=sorted(IMAGE_FORMATS),
+                                          dest="image_format",
+                                          help="default format of annotated frame replies")
+    pipeline.Pipeline.parser.add_argument("--imageQuality", type=int,
+                                          dest="image_quality",
+                                          help="default quality of jpeg and webp replies")
     args = pipeline.Pipeline.parser.parse_args()
     kwargs = vars(args)
-    application.listen(kwargs["port"])
-    del kwargs["port"]
-    PIPELINE = pipeline.Pipeline.create(**kwargs)
-    tornado.ioloop.IOLoop.instance().start()
\ No newline at end of file
+    port = kwargs.pop("port")
+    nprocesses = kwargs.pop("processes") or multiprocessing.cpu_count()
+    MAX_PENDING = kwargs.pop("max_pending")
+    REPLY_MODE = kwargs.pop("reply")
+    IMAGE_FORMAT = kwargs.pop("image_format")
+    IMAGE_QUALITY = kwargs.pop("image_quality")
+    nworkers = kwargs.pop("workers") or max(1, multiprocessing.cpu_count() / nprocesses)
+    inflight = kwargs.pop("inflight")
+    kind = kwargs.pop("executor")
+
+    if nprocesses > 1:
+        # Parse the cascades before forking, so every server process shares
+        # their pages copy-on-write. The forked processes accept connections
+        # on the same socket, and a websocket stays in the process that
+        # accepted it, along with its pipeline.
+        sockets = tornado.netutil.bind_sockets(port)
+        pipeline.CASCADES.preload([kwargs.get("face_cascade_name") or pipeline.FACE_CASCADE_NAME,
+                                   kwargs.get("hand_cascade_name") or pipeline.HAND_CASCADE_NAME],
+                                  copies=nworkers if kind == "thread" else 1)
+        task_id = tornado.process.fork_processes(nprocesses)
+        print "Server process " + str(task_id) + " started, pid " + str(os.getpid())
+
+    # Threads don't survive a fork, so workers start in every server process
+    if kind == "pipelined":
+        WORKERS = workers.PipelinedPool(nworkers, inflight, **kwargs)
+    else:
+        WORKERS = workers.WorkerPool(nworkers, kind, **kwargs)
+    if nprocesses > 1:
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets(sockets)
+    else:
+        application.listen(port)
+    tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,421 @@
+import cv2
+import detect
+import numpy as np
+
+class FrameState(object):
+    """
+    Intermediate results of one call to Pipeline.detect, shared by the stages.
+    Each stage reads the results of the stages before it and adds its own,
+    so nothing is computed twice, and debug views can be rendered from the
+    cached results afterwards. Intermediate images are taken from a
+    BufferPool if one is given, and given back once the call finished, so
+    they are only valid until the next call.
+    """
+
+    def __init__(self, context1, context2, keep_original=False, pool=None):
+        """
+        Constructor. If keep_original is set, an unannotated copy of the
+        first frame is kept for the debug views.
+        """
+        self.pool = pool
+        self.buffers = []
+        self.context1 = context1
+        self.context2 = context2
+        self.original = context1.frame.copy() if keep_original else None
+
+        # Frame annotated by the stages, returned by detect
+        self.frame = context1.frame
+
+        # Working image, handed from each preprocessing stage to the next
+        self.image = context1.frame
+
+        self.faces = []
+        self.no_faces = None
+        self.foreground = None
+        self.search = None
+        self.candidates = []
+        self.largest = detect.Rect(0, 0, 0, 0)
+        self.mask = None
+        self.direction = (0, 0)
+        self.vectors = None
+        self.correction = None
+
+        # Set by a stage to skip the remaining stages
+        self.done = False
+
+        # Set by the motion gate to reuse the results of the previous call
+        self.gated = False
+
+        # Traceback of a stage that failed, when stages run on other threads
+        self.error = None
+
+    def buffer(self, shape, dtype=np.uint8):
+        """ Returns a scratch image, valid until the state is released. """
+        if self.pool is None:
+            return np.empty(shape, dtype=dtype)
+        buffer = self.pool.take(shape, dtype)
+        self.buffers.append(buffer)
+        return buffer
+
+    def release(self):
+        """ Gives the scratch images back to the pool. """
+        for buffer in self.buffers:
+            self.pool.give(buffer)
+        self.buffers = []
+
+    def reuse(self, last):
+        """
+        Takes the boxes found in the previous call, with no direction, and
+        draws them on the frame.
+        """
+        self.faces = last.faces
+        self.search = last.search
+        self.candidates = last.candidates
+        self.largest = last.largest
+        self.correction = last.correction
+        detect.CascadeDetector.largest(self.frame, self.candidates, draw=True)
+
+    def current(self):
+        """
+        Returns the working image, as the context of the first frame if no
+        stage has changed it yet, so its conversions are shared.
+        """
+        if self.image is self.context1.frame:
+            return self.context1
+        return self.image
+
+class Stage(object):
+    """
+    Abstract class for the stages of a pipeline. A stage runs once per frame,
+    and reads and writes the FrameState.
+    """
+
+    # Name of the stage, used for profiling
+    name = None
+
+    def run(self, state):
+        """ All implementing classes must implement this method. """
+        raise Exception("Must subclass implement")
+
+    def stats(self):
+        """ Returns counters describing the work done by the stage. """
+        return {}
+
+class MotionGate(Stage):
+    """
+    Skips the remaining stages when the scene barely changed between the two
+    frames, and marks the state to reuse the result of the previous call,
+    with no direction. The change is the mean absolute difference of the
+    grayscale frames, downsampled by scale, so it costs a fraction of a
+    cascade run. The previous result is only taken once the previous call
+    finished, see Pipeline.finish, as stages may overlap across frames.
+    """
+
+    name = "gate"
+
+    def __init__(self, threshold, scale=0.25):
+        self.threshold = threshold
+        self.scale = scale
+
+        # Counters of frames seen and of frames skipped
+        self.frames = 0
+        self.skipped = 0
+
+    def run(self, state):
+        self.frames += 1
+        change = cv2.absdiff(state.context1.small(self.scale),
+                             state.context2.small(self.scale)).mean()
+        if self.frames > 1 and change < self.threshold:
+            self.skipped += 1
+            state.gated = True
+            state.done = True
+
+    def stats(self):
+        return {"frames": self.frames,
+                "skipped": self.skipped,
+                "hit_rate": float(self.skipped) / max(1, self.frames)}
+
+class RemoveFaces(Stage):
+    """
+    Detects faces and zeroes them out of the working image. Faces barely
+    move, so the face cascade can run only every interval frames, or as soon
+    as the faces moved more than motion_threshold pixels since it last ran.
+    In between, the last faces are carried forward, and if nudge is set,
+    moved along with their motion. The motion of the faces is measured with
+    Lucas-Kanade within the face boxes only, so a hand waving in front of a
+    still face neither moves the boxes nor runs the cascade again.
+    """
+
+    name = "faces"
+
+    def __init__(self, face_cascade, interval=1, motion_threshold=None,
+                 nudge=False):
+        self.face_cascade = face_cascade
+        self.interval = interval
+        self.motion_threshold = motion_threshold
+        self.nudge = nudge
+        self.faces = []
+        self.age = None
+        self.motion = 0.
+
+        # Counters of frames seen and of cascade runs
+        self.frames = 0
+        self.runs = 0
+
+    def run(self, state):
+        self.frames += 1
+        if (self.age is None or self.age + 1 >= self.interval or
+            (self.motion_threshold is not None and
+             self.motion > self.motion_threshold)):
+            self.faces = self.face_cascade.find(state.current(), minNeighbors=2,
+                                                minSize=(30,30))
+            self.age = 0
+            self.motion = 0.
+            self.runs += 1
+        else:
+            self.age += 1
+        state.faces = self.faces
+        state.no_faces = self.face_cascade.remove(
+            state.image, state.faces,
+            out=state.buffer(state.image.shape, state.image.dtype))
+        state.image = state.no_faces
+        if ((self.nudge or self.motion_threshold is not None) and
+            len(self.faces) > 0):
+            self.track(state)
+
+    def track(self, state):
+        """
+        Measures the motion of the faces into the second frame, which is
+        the first frame of the next call, and moves them along if nudging.
+        """
+        mask = state.buffer(state.frame.shape[:2])
+        mask.fill(0)
+        for face in self.faces:
+            mask[detect.Rect(*face[:4]).slices(mask.shape)] = 255
+        motion = detect.LKOpticalFlow.median_motion(state.context1,
+                                                    state.context2, mask)
+        self.motion += detect.VMath.norm(motion)
+        if self.nudge:
+            # A copy, since state.faces keeps the boxes of this frame
+            self.faces = np.array(self.faces)
+            self.faces[:, :2] += np.round(motion).astype(self.faces.dtype)
+
+    def stats(self):
+        if self.interval <= 1 and self.motion_threshold is None:
+            return {}
+        return {"frames": self.frames,
+                "runs": self.runs,
+                "run_rate": float(self.runs) / max(1, self.frames)}
+
+class RemoveBackground(Stage):
+    """ Zeroes the background out of the working image. """
+
+    name = "background"
+
+    def __init__(self, subtractor):
+        self.subtractor = subtractor
+
+    def run(self, state):
+        state.foreground = self.subtractor.bgremove(
+            state.image, out=state.buffer(state.image.shape, state.image.dtype))
+        state.image = state.foreground
+
+class PredictWindow(Stage):
+    """ Predicts the window to search for the hand in. """
+
+    name = "window"
+
+    def __init__(self, kalman):
+        self.kalman = kalman
+
+    def run(self, state):
+        state.search = self.kalman.predict()
+
+class FindHands(Stage):
+    """
+    Detects hands in the working image, only within the predicted window if
+    there is one. If coarse_scale is set, searches that have to cover the
+    whole frame, e.g. once the window lost the hand, run coarse to fine.
+
+    If track_interval is set, the hand found by the cascade is followed by
+    template matching instead, within the predicted window or around its
+    last position, and the cascade only runs again after track_interval
+    tracked frames, or as soon as the match score drops below
+    track_threshold.
+    """
+
+    name = "hands"
+
+    def __init__(self, hand_cascade, scaleFactor=1.1, minNeighbors=60,
+                 margin=10, minSize=(25,35), coarse_scale=None,
+                 coarse_min_neighbors=5, track_interval=None,
+                 track_threshold=0.6):
+        self.hand_cascade = hand_cascade
+        self.scaleFactor = scaleFactor
+        self.minNeighbors = minNeighbors
+        self.margin = margin
+        self.minSize = minSize
+        self.coarse_scale = coarse_scale
+        self.coarse_min_neighbors = coarse_min_neighbors
+        self.track_interval = track_interval
+        self.track_threshold = track_threshold
+        self.tracker = detect.TemplateTracker()
+        self.tracked_box = None
+        self.age = 0
+
+        # Counters of frames seen, of coarse to fine searches, of frames
+        # tracked instead of searched, and of tracks lost
+        self.frames = 0
+        self.coarse = 0
+        self.tracked = 0
+        self.lost = 0
+
+    def run(self, state):
+        self.frames += 1
+        if self.track_interval is not None and self.tracker.tracking():
+            if self.age < self.track_interval and self.track(state):
+                return
+            self.tracker.stop()
+        self.search(state)
+        if self.track_interval is not None and len(state.candidates) > 0:
+            best = max(state.candidates, key=lambda rect: rect[2] * rect[3])
+            self.tracked_box = detect.Rect(*best[:4])
+            self.tracker.start(state.context1.equalized(), self.tracked_box)
+            self.age = 0
+
+    def windowed(self, state):
+        """ Returns whether the predicted window is smaller than the frame. """
+        shape = state.frame.shape
+        return state.search is not None and (state.search.width < shape[1] or
+                                             state.search.height < shape[0])
+
+    def track(self, state):
+        """
+        Follows the hand found last. Returns whether it was found with a
+        high enough score.
+        """
+        if self.windowed(state):
+            region = state.search.clip(state.frame.shape, self.margin)
+        else:
+            box = self.tracked_box
+            region = box.clip(state.frame.shape, max(box.width, box.height) / 2)
+        box, score = self.tracker.track(state.context1.equalized(), region)
+        if box is None or score < self.track_threshold:
+            self.lost += 1
+            return False
+        state.candidates = [[box.x, box.y, box.width, box.height]]
+        self.tracked_box = box
+        self.age += 1
+        self.tracked += 1
+        return True
+
+    def search(self, state):
+        """ Runs the hand cascade. """
+        if self.windowed(state):
+            state.candidates = self.hand_cascade.find_within(
+                state.image, state.search, margin=self.margin,
+                scaleFactor=self.scaleFactor, minNeighbors=self.minNeighbors,
+                minSize=self.minSize, pool=state.pool)
+        elif self.coarse_scale is not None:
+            self.coarse += 1
+            state.candidates = self.hand_cascade.find_coarse(
+                state.current(), scale=self.coarse_scale, margin=self.margin,
+                coarseMinNeighbors=self.coarse_min_neighbors,
+                scaleFactor=self.scaleFactor, minNeighbors=self.minNeighbors,
+                minSize=self.minSize, pool=state.pool)
+        else:
+            state.candidates = self.hand_cascade.find(
+                state.current(), scaleFactor=self.scaleFactor,
+                minNeighbors=self.minNeighbors, minSize=self.minSize)
+
+    def stats(self):
+        stats = {}
+        if self.coarse_scale is not None:
+            stats["coarse"] = self.coarse
+        if self.track_interval is not None:
+            stats["tracked"] = self.tracked
+            stats["lost"] = self.lost
+            stats["track_rate"] = float(self.tracked) / max(1, self.frames)
+        if stats:
+            stats["frames"] = self.frames
+        return stats
+
+class FindFaces(Stage):
+    """ Detects faces as the objects to track. """
+
+    name = "findfaces"
+
+    def __init__(self, face_cascade):
+        self.face_cascade = face_cascade
+
+    def run(self, state):
+        state.candidates = self.face_cascade.find(state.current(), scaleFactor=1.1,
+                                                  minNeighbors=2, minSize=(30,30))
+
+class Largest(Stage):
+    """ Picks the largest candidate, and masks the frame around it. """
+
+    name = "largest"
+
+    def run(self, state):
+        state.largest = detect.CascadeDetector.largest(state.frame, state.candidates,
+                                                       draw=True)
+        state.mask = state.largest.mask(state.frame,
+                                        out=state.buffer(state.frame.shape[:2]))
+
+class OpticalFlow(Stage):
+    """ Computes the overall direction of the motion within the mask. """
+
+    name = "flow"
+
+    def __init__(self, optical):
+        self.optical = optical
+
+    def run(self, state):
+        state.direction, state.frame = self.optical.direction(
+            state.context1, state.context2, mask=state.mask)
+        state.vectors = self.optical.vectors
+
+class CorrectWindow(Stage):
+    """ Corrects the window estimate with the measured hand and direction. """
+
+    name = "correct"
+
+    def __init__(self, kalman):
+        self.kalman = kalman
+
+    def run(self, state):
+        state.correction = self.kalman.correct(state.largest, state.direction)
+        state.correction.draw(state.frame, detect.Color.BLUE)
+
+class View(object):
+    """
+    Debug window showing an intermediate result, annotated with the hands
+    found by the pipeline. Views are rendered from the FrameState once all
+    the stages ran, so they never run a detector again.
+    """
+
+    def __init__(self, title, key, window=False):
+        """
+        Constructor. key is the FrameState attribute holding the image, and
+        if window is set, only the predicted window of the image is shown.
+        """
+        self.title = title
+        self.key = key
+        self.window = window
+
+    def render(self, state):
+        image = getattr(state, self.key)
+        if image is None:
+            return
+        if self.window:
+            if state.search is None:
+                return
+            image = state.search.filter(image,
+                                        out=state.buffer(image.shape, image.dtype))
+        else:
+            copy = state.buffer(image.shape, image.dtype)
+            copy[...] = image
+            image = copy
+        detect.CascadeDetector.largest(image, state.candidates, draw=True)
+        cv2.imshow(self.title, image)
@@ -19,20 +19,92 @@ $(document).ready(function(){
     ctx.translate(MotionApp.WIDTH, 0);
     ctx.scale(-1, 1);
 
-    // move map in the corresponding direction
-    function get_direction(float_blob) {
-        var reader = new FileReader();
-        reader.onload = (function(blob) {
-            return function(event) {
-                var x = parseFloat(event.target.result.slice(0,5))
-                    * MotionApp.WIDTH * MotionApp.SCALE_FACTOR;
-                var y = parseFloat(event.target.result.slice(5,10))
-                    * MotionApp.HEIGHT * MotionApp.SCALE_FACTOR;
-                direction.html(x + "," + y);
-                map.panBy(x, y);
-            };
-        })(float_blob);
-        reader.readAsBinaryString(float_blob);
+    var overlay = $("#overlay");
+    var overlay_ctx = overlay.get()[0].getContext('2d');
+
+    // move map by the direction, normalized by the frame size
+    function move_map(dx, dy) {
+        var x = dx * MotionApp.WIDTH * MotionApp.SCALE_FACTOR;
+        var y = dy * MotionApp.HEIGHT * MotionApp.SCALE_FACTOR;
+        direction.html(x + "," + y);
+        map.panBy(x, y);
+    }
+
+    // image replies start with the direction as text, e.g. "+0.12-0.13",
+    // followed by the annotated frame
+    function on_image_reply(buffer) {
+        var text = String.fromCharCode.apply(null, new Uint8Array(buffer, 0, 10));
+        move_map(parseFloat(text.slice(0,5)), parseFloat(text.slice(5,10)));
+
+        // display the updated frame
+        var target = document.getElementById("target");
+        var url = window.webkitURL.createObjectURL(new Blob([buffer.slice(10)]));
+        target.onload = function() {
+            window.webkitURL.revokeObjectURL(url);
+        };
+        target.src = url;
+    }
+
+    // geometry replies hold the overlay only, see codec.encode_geometry:
+    // "G", direction (2 float32), largest box and window box (4 int16 each),
+    // number of candidates and of flow vectors (uint16 each), candidate
+    // boxes (4 int16 each) and flow vectors (4 float32 each), little-endian
+    function on_geometry_reply(buffer) {
+        var view = new DataView(buffer);
+        var dx = view.getFloat32(1, true);
+        var dy = view.getFloat32(5, true);
+        function box(offset) {
+            return [view.getInt16(offset, true), view.getInt16(offset + 2, true),
+                    view.getInt16(offset + 4, true), view.getInt16(offset + 6, true)];
+        }
+        var largest = box(9);
+        var window_box = box(17);
+        var ncandidates = view.getUint16(25, true);
+        var nvectors = view.getUint16(27, true);
+        var offset = 29;
+
+        // draw the overlay alone, on a transparent canvas laid over the
+        // frames being sent. The canvas may already hold a newer frame than
+        // the reply describes, so it is not copied under the overlay.
+        overlay_ctx.clearRect(0, 0, MotionApp.WIDTH, MotionApp.HEIGHT);
+        overlay_ctx.lineWidth = 1;
+        overlay_ctx.strokeStyle = "yellow";
+        for (var i = 0; i < ncandidates; i++, offset += 8) {
+            overlay_ctx.strokeRect.apply(overlay_ctx, box(offset));
+        }
+        overlay_ctx.strokeStyle = "lime";
+        overlay_ctx.strokeRect.apply(overlay_ctx, largest);
+        overlay_ctx.strokeStyle = "blue";
+        overlay_ctx.strokeRect.apply(overlay_ctx, window_box);
+        overlay_ctx.beginPath();
+        for (var i = 0; i < nvectors; i++, offset += 16) {
+            overlay_ctx.moveTo(view.getFloat32(offset, true),
+                               view.getFloat32(offset + 4, true));
+            overlay_ctx.lineTo(view.getFloat32(offset + 8, true),
+                               view.getFloat32(offset + 12, true));
+        }
+        overlay_ctx.stroke();
+        var cx = MotionApp.WIDTH / 2;
+        var cy = MotionApp.HEIGHT / 2;
+        overlay_ctx.lineWidth = 3;
+        overlay_ctx.strokeStyle = "white";
+        overlay_ctx.beginPath();
+        overlay_ctx.moveTo(cx, cy);
+        overlay_ctx.lineTo(cx + dx, cy + dy);
+        overlay_ctx.stroke();
+
+        move_map(dx / MotionApp.WIDTH, dy / MotionApp.HEIGHT);
+    }
+
+    // decode a base64 data url into its raw bytes, so frames can be sent
+    // as binary messages without the base64 overhead
+    function data_url_to_buffer(url) {
+        var bytes = window.atob(url.split(',')[1]);
+        var buffer = new Uint8Array(bytes.length);
+        for (var i = 0; i < bytes.length; i++) {
+            buffer[i] = bytes.charCodeAt(i);
+        }
+        return buffer.buffer;
     }
 
     // interval variable to send a constant stream to the server
@@ -40,21 +112,19 @@ $(document).ready(function(){
 
     // establish websocket
     var ws = new WebSocket("ws://" + MotionApp.HOST + ":" +
-                           MotionApp.PORT + "/websocket");
+                           MotionApp.PORT + "/websocket?reply=" + MotionApp.REPLY +
+                           "&format=" + MotionApp.IMAGE_FORMAT +
+                           "&quality=" + MotionApp.IMAGE_QUALITY);
+    ws.binaryType = "arraybuffer";
     ws.onopen = function() {
         console.log("Opened connection to websocket");
     };
     ws.onmessage = function(msg) {
-        // display the updated frame
-        var target = document.getElementById("target");
-        url = window.webkitURL.createObjectURL(msg.data.slice(10, msg.data.size));
-        target.onload = function() {
-            window.webkitURL.revokeObjectURL(url);
-        };
-        target.src = url;
-
-        // handle the direction of the motion in the frame
-        get_direction(msg.data.slice(0,10));
+        if (new Uint8Array(msg.data, 0, 1)[0] == "G".charCodeAt(0)) {
+            on_geometry_reply(msg.data);
+        } else {
+            on_image_reply(msg.data);
+        }
     };
     ws.onclose = function(msg) {
         window.clearInterval(timer);
@@ -71,7 +141,7 @@ $(document).ready(function(){
                 function () {
                     ctx.drawImage(video, 0, 0, MotionApp.WIDTH, MotionApp.HEIGHT);
                     var data = canvas.get()[0].toDataURL('image/jpeg', 1.0);
-                    ws.send(data.split(',')[1]);
+                    ws.send(data_url_to_buffer(data));
                 }, 250);
         },
         function(err) {
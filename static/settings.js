@@ -4,4 +4,7 @@ MotionApp = {
     WIDTH: 320,
     HEIGHT: 240,
     SCALE_FACTOR: 0.5,
+    REPLY: "image",
+    IMAGE_FORMAT: "jpeg",
+    IMAGE_QUALITY: 80,
 };
\ No newline at end of file
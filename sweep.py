@@ -0,0 +1,190 @@
+import collections
+import framestore
+import groundtruth
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import random
+import time
+import traceback
+from detect import VMath
+from pipeline import Pipeline
+
+# Values tried for every parameter of the sweep
+PARAMETERS = collections.OrderedDict([
+    ("haarScaleFactor", [1.05, 1.1, 1.2, 1.3]),
+    ("haarMinNeighbors", [20, 40, 60, 80]),
+    ("window_width", [80, 100, 140]),
+    ("window_height", [140, 180, 220]),
+    ("nframes", [10, 20, 40]),
+    ("threshold", [10, 20, 30]),
+    ("directionScale", [0.01, 0.02, 0.05]),
+])
+
+# Frames of the recording, loaded once in every worker
+FRAMES = None
+
+def _init_worker(directory):
+    global FRAMES
+    FRAMES = list(framestore.load(directory))
+    if len(FRAMES) < 2:
+        raise Exception("not enough frames in " + directory)
+
+def run(kwargs):
+    """
+    Runs a pipeline with the given arguments over the recording. Returns the
+    per-frame latencies in milliseconds, and the largest box and direction
+    of every frame.
+    """
+    # detect draws on its frames, so every run gets clean copies
+    frames = [frame.copy() for frame in FRAMES]
+    pipeline = Pipeline.create(**kwargs)
+    latencies = []
+    boxes = []
+    directions = []
+    for prev, current in zip(frames, frames[1:]):
+        time_start = time.time()
+        largest, direction, frame_out = pipeline.detect(prev, current)
+        latencies.append((time.time() - time_start) * 1000)
+        boxes.append(largest)
+        directions.append(direction)
+    return latencies, boxes, directions
+
+def _run(args):
+    setting, kwargs = args
+    try:
+        return setting, run(kwargs), None
+    except Exception:
+        return setting, None, traceback.format_exc()
+
+def score(result, reference, labels=None):
+    """
+    Scores the latency of a run, and its results against the ground truth
+    labels with groundtruth.score. Without labels, the results are scored
+    against the run of the reference configuration instead: mean IoU of the
+    largest boxes, and mean distance between directions.
+    """
+    latencies, boxes, directions = result
+    if labels is not None:
+        report = groundtruth.score(boxes, directions, labels)
+    else:
+        ref_latencies, ref_boxes, ref_directions = reference
+        report = {
+            "iou": np.mean([box.iou(ref) for box, ref in zip(boxes, ref_boxes)]),
+            "direction_error": np.mean([VMath.dist(d, ref) for d, ref
+                                        in zip(directions, ref_directions)]),
+        }
+    latencies = np.array(latencies)
+    report["mean_ms"] = latencies.mean()
+    report["p90_ms"] = np.percentile(latencies, 90)
+    return report
+
+def settings(names, search, samples, seed):
+    """
+    Returns the settings to try, as dictionaries of parameter to value: every
+    combination of the values of the named parameters for a grid search, or
+    samples random combinations for a random search.
+    """
+    grid = [PARAMETERS[name] for name in names]
+    if search == "grid":
+        combinations = list(itertools.product(*grid))
+    else:
+        generator = random.Random(seed)
+        combinations = set()
+        total = np.prod([len(values) for values in grid])
+        while len(combinations) < min(samples, total):
+            combinations.add(tuple(generator.choice(values) for values in grid))
+        combinations = sorted(combinations)
+    return [collections.OrderedDict(zip(names, values)) for values in combinations]
+
+def pareto(scores):
+    """
+    Returns the (setting, score) pairs no other pair beats on both latency
+    and IoU, sorted by latency.
+    """
+    front = []
+    for setting, s in scores:
+        dominated = False
+        for other_setting, other in scores:
+            if (other["mean_ms"] <= s["mean_ms"] and other["iou"] >= s["iou"] and
+                (other["mean_ms"] < s["mean_ms"] or other["iou"] > s["iou"])):
+                dominated = True
+                break
+        if not dominated:
+            front.append((setting, s))
+    return sorted(front, key=lambda (setting, s): s["mean_ms"])
+
+def main(directory, names, search, samples, seed, processes, output, **kwargs):
+    kwargs.pop("profile", None)
+    kwargs = dict((k, v) for k, v in kwargs.items() if v is not None)
+    labels = None
+    if os.path.exists(groundtruth.labels_path(directory)):
+        labels = groundtruth.load_labels(directory)
+    else:
+        print ("warning: no labels in %s, scoring against the reference "
+               "configuration instead" % directory)
+    pool = multiprocessing.Pool(processes, _init_worker, (directory,))
+
+    # The configuration given on the command line is the reference
+    setting, reference, error = pool.apply(_run, ((None, kwargs),))
+    if error is not None:
+        print "reference failed:\n" + error
+        return
+
+    tasks = []
+    for setting in settings(names, search, samples, seed):
+        setting_kwargs = dict(kwargs)
+        setting_kwargs.update(setting)
+        tasks.append((setting, setting_kwargs))
+    scores = []
+    for setting, result, error in pool.imap_unordered(_run, tasks):
+        if error is not None:
+            print "%s failed:\n%s" % (dict(setting), error)
+            continue
+        scores.append((setting, score(result, reference, labels)))
+    pool.close()
+
+    front = pareto(scores)
+    print "%d settings, %d on the pareto front (reference: %.2f ms)" % (
+        len(scores), len(front), np.mean(reference[0]))
+    print "%8s %8s %6s %8s  %s" % ("mean_ms", "p90_ms", "iou", "dir_err", "setting")
+    for setting, s in front:
+        print "%8.2f %8.2f %6.3f %8.2f  %s" % (
+            s["mean_ms"], s["p90_ms"], s["iou"], s["direction_error"],
+            " ".join("--%s=%s" % item for item in setting.items()))
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump({"dataset": directory,
+                       "labelled": labels is not None,
+                       "reference": kwargs,
+                       "settings": [dict(setting, **s) for setting, s in scores],
+                       "pareto": [dict(setting, **s) for setting, s in front]},
+                      f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    Pipeline.parser.add_argument("--data", type=str, default="data/analysis",
+                                 dest="directory",
+                                 help="directory of recorded frames")
+    Pipeline.parser.add_argument("--params", type=str, nargs="+",
+                                 choices=PARAMETERS.keys(),
+                                 default=PARAMETERS.keys(), dest="names",
+                                 help="parameters to sweep")
+    Pipeline.parser.add_argument("--search", type=str, default="random",
+                                 choices=["grid", "random"], dest="search",
+                                 help="try every combination or random ones")
+    Pipeline.parser.add_argument("--samples", type=int, default=50,
+                                 dest="samples",
+                                 help="number of settings for a random search")
+    Pipeline.parser.add_argument("--seed", type=int, default=0, dest="seed",
+                                 help="seed of the random search")
+    Pipeline.parser.add_argument("--processes", type=int,
+                                 default=multiprocessing.cpu_count(),
+                                 dest="processes",
+                                 help="number of settings to run at once")
+    Pipeline.parser.add_argument("--output", type=str, dest="output",
+                                 help="file to write the json report to")
+    args = Pipeline.parser.parse_args()
+    main(**vars(args))
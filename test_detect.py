@@ -0,0 +1,86 @@
+import numpy as np
+import unittest
+from detect import CascadeDetector, Rect
+from pipeline import FACE_CASCADE_NAME
+
+class RectTest(unittest.TestCase):
+
+    def test_slices_clip_negative_origin(self):
+        rows, cols = Rect(-5, -10, 20, 30).slices((40, 60, 3))
+        self.assertEqual((rows.start, rows.stop), (0, 20))
+        self.assertEqual((cols.start, cols.stop), (0, 15))
+
+    def test_slices_clip_past_frame(self):
+        rows, cols = Rect(50, 30, 20, 30).slices((40, 60, 3))
+        self.assertEqual((rows.start, rows.stop), (30, 40))
+        self.assertEqual((cols.start, cols.stop), (50, 60))
+
+    def test_slices_outside_frame(self):
+        rows, cols = Rect(-30, 5, 20, 10).slices((40, 60, 3))
+        self.assertEqual(cols.stop - cols.start, 0)
+
+    def test_mask(self):
+        frame = np.ones((40, 60, 3), dtype=np.uint8)
+        expected = np.zeros((40, 60), dtype=np.uint8)
+        expected[5:15, 10:30] = 1
+        rect = Rect(10, 5, 20, 10)
+        np.testing.assert_array_equal(rect.mask(frame), expected)
+
+        # out is cleared before the box is written
+        out = np.full((40, 60), 7, dtype=np.uint8)
+        self.assertIs(rect.mask(frame, out), out)
+        np.testing.assert_array_equal(out, expected)
+
+    def test_filter(self):
+        frame = np.arange(40 * 60 * 3, dtype=np.uint8).reshape((40, 60, 3))
+        expected = np.zeros_like(frame)
+        expected[5:15, 10:30] = frame[5:15, 10:30]
+        rect = Rect(10, 5, 20, 10)
+        np.testing.assert_array_equal(rect.filter(frame), expected)
+
+        out = np.full(frame.shape, 7, dtype=np.uint8)
+        self.assertIs(rect.filter(frame, out), out)
+        np.testing.assert_array_equal(out, expected)
+
+    def test_iou(self):
+        rect = Rect(0, 0, 10, 10)
+        self.assertEqual(rect.iou(Rect(0, 0, 10, 10)), 1.)
+        self.assertAlmostEqual(rect.iou(Rect(5, 0, 10, 10)), 50. / 150)
+        self.assertEqual(rect.iou(Rect(20, 20, 10, 10)), 0.)
+
+    def test_iou_empty(self):
+        # No object on either side is a perfect match, on one side a miss
+        self.assertEqual(Rect(0, 0, 0, 0).iou(Rect(0, 0, 0, 0)), 1.)
+        self.assertEqual(Rect(0, 0, 0, 0).iou(Rect(0, 0, 10, 10)), 0.)
+        self.assertEqual(Rect(0, 0, 10, 10).iou(Rect(0, 0, 0, 0)), 0.)
+
+class RemoveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.detector = CascadeDetector(FACE_CASCADE_NAME)
+
+        # Wider than tall, so swapping rows and columns shows
+        self.frame = np.full((40, 60, 3), 9, dtype=np.uint8)
+        self.objects = [[35, 5, 20, 10]]
+        self.expected = self.frame.copy()
+        self.expected[5:15, 35:55] = 0
+
+    def test_remove(self):
+        result = self.detector.remove(self.frame, self.objects)
+        np.testing.assert_array_equal(result, self.expected)
+        self.assertTrue((self.frame == 9).all())
+
+    def test_remove_into_out(self):
+        out = np.zeros_like(self.frame)
+        result = self.detector.remove(self.frame, self.objects, out)
+        self.assertIs(result, out)
+        np.testing.assert_array_equal(out, self.expected)
+        self.assertTrue((self.frame == 9).all())
+
+    def test_remove_in_place(self):
+        result = self.detector.remove(self.frame, self.objects, self.frame)
+        self.assertIs(result, self.frame)
+        np.testing.assert_array_equal(self.frame, self.expected)
+
+if __name__ == "__main__":
+    unittest.main()
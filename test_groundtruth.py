@@ -0,0 +1,49 @@
+import groundtruth
+import unittest
+from detect import Rect
+
+class ScoreTest(unittest.TestCase):
+
+    def setUp(self):
+        # The hand moves right by 10 pixels a frame, then leaves
+        self.labels = {0: Rect(0, 0, 10, 10),
+                       1: Rect(10, 0, 10, 10),
+                       2: Rect(20, 0, 10, 10),
+                       3: Rect(0, 0, 0, 0)}
+
+    def test_perfect(self):
+        boxes = [self.labels[i] for i in range(4)]
+        directions = [(5, 0), (5, 0), (0, 0), (0, 0)]
+        report = groundtruth.score(boxes, directions, self.labels)
+        self.assertEqual(report["frames"], 4)
+        self.assertEqual(report["iou"], 1.)
+        self.assertEqual(report["hit_rate"], 1.)
+
+        # The hand leaves after frame 2, so only frames 0 and 1 have motion
+        self.assertEqual(report["direction_frames"], 2)
+        self.assertAlmostEqual(report["direction_error"], 0.)
+
+    def test_misses(self):
+        boxes = [Rect(5, 0, 10, 10), Rect(0, 0, 0, 0),
+                 Rect(20, 0, 10, 10), Rect(0, 0, 10, 10)]
+        directions = [(0, 5), (-5, 0), (0, 0), (0, 0)]
+        report = groundtruth.score(boxes, directions, self.labels)
+        self.assertAlmostEqual(report["iou"], (50. / 150 + 0 + 1 + 0) / 4)
+        self.assertEqual(report["hit_rate"], 0.25)
+        self.assertAlmostEqual(report["direction_error"], (90. + 180.) / 2)
+
+    def test_unlabelled_frames(self):
+        labels = {1: self.labels[1]}
+        boxes = [Rect(0, 0, 0, 0), self.labels[1], Rect(0, 0, 0, 0)]
+        directions = [(0, 0)] * 3
+        report = groundtruth.score(boxes, directions, labels)
+        self.assertEqual(report["frames"], 1)
+        self.assertEqual(report["iou"], 1.)
+        self.assertEqual(report["direction_frames"], 0)
+
+    def test_no_labels(self):
+        self.assertRaises(Exception, groundtruth.score,
+                          [Rect(0, 0, 0, 0)], [(0, 0)], {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,342 @@
+import codec
+import collections
+import executor
+import multiprocessing
+import multiprocessing.pool
+import pipeline
+import Queue
+import threading
+import tornado.ioloop
+import traceback
+
+# Worker-local storage. Each worker thread or process owns the pipelines of
+# the sessions pinned to it.
+_LOCAL = threading.local()
+
+def _init_worker(kwargs):
+    """ Initializer run once in every worker. """
+    _LOCAL.kwargs = kwargs
+    _LOCAL.sessions = {}
+
+# Replies sent back by default: the annotated frame, encoded as PNG
+IMAGE_REPLY = ("image", ".png", None)
+
+def _detect(session, frame1, frame2, reply=IMAGE_REPLY):
+    """
+    Runs the session's pipeline on a pair of frames and encodes the reply.
+    reply is either ("image", ext, quality), for the annotated frame encoded
+    with codec.encode_frame, or ("geometry",), for the overlay encoded with
+    codec.encode_geometry. The pipeline is created on the first frame of the
+    session, which is cheap since cascades come from the shared registry.
+    Returns a tuple (error, result), where result is the overall direction,
+    the encoded reply and the counters of the pipeline, since exceptions
+    raised in a pool are never passed to the callback.
+    """
+    try:
+        session_pipeline = _LOCAL.sessions.get(session)
+        if session_pipeline is None:
+            session_pipeline = pipeline.Pipeline.create(**_LOCAL.kwargs)
+            _LOCAL.sessions[session] = session_pipeline
+        session_pipeline.detect(frame1, frame2)
+        return None, _encode(session_pipeline, reply)
+    except Exception:
+        return traceback.format_exc(), None
+
+def _encode(session_pipeline, reply):
+    """
+    Encodes the reply for the last pair of frames processed by a pipeline,
+    and returns the overall direction, the encoded reply and the counters
+    of the pipeline (see Pipeline.stats).
+    """
+    state = session_pipeline.state
+    if reply[0] == "geometry":
+        payload = codec.encode_geometry(
+            state.direction, state.largest, state.correction or state.search,
+            state.candidates, state.vectors if state.vectors is not None else [])
+    else:
+        ext, quality = reply[1:]
+        payload = codec.encode_frame(state.frame, ext, quality=quality)
+    return state.direction, payload, session_pipeline.stats()
+
+def _close(session):
+    """ Drops the pipeline state of a closed session. """
+    _LOCAL.sessions.pop(session, None)
+
+class WorkerPool(object):
+    """
+    Runs pipelines off the tornado IOLoop on a fixed set of workers. Each
+    worker is a pool with a single thread or process, and keeps a separate
+    pipeline for every session pinned to it, so the frames of a session are
+    processed in order and its tracking state is never shared.
+    OpenCV releases the GIL, so threads work well; processes avoid the GIL
+    altogether, at the cost of pickling frames.
+    """
+
+    def __init__(self, nworkers, kind="thread", **kwargs):
+        """
+        Constructor. kind is either "thread" or "process", and kwargs are
+        passed to Pipeline.create in every worker.
+        """
+        if kind == "thread":
+            pool_class = multiprocessing.pool.ThreadPool
+        elif kind == "process":
+            pool_class = multiprocessing.Pool
+        else:
+            raise Exception("unsupported executor: " + kind)
+
+        # Parse the cascades once, before process workers are forked
+        cascade_names = [kwargs.get("face_cascade_name") or pipeline.FACE_CASCADE_NAME,
+                         kwargs.get("hand_cascade_name") or pipeline.HAND_CASCADE_NAME]
+        pipeline.CASCADES.preload(cascade_names,
+                                  copies=nworkers if kind == "thread" else 1)
+        self.pools = [pool_class(1, _init_worker, (kwargs,))
+                      for i in range(nworkers)]
+        self.sessions = [0] * nworkers
+
+    def assign(self):
+        """
+        Pins a new session to the worker with the fewest sessions, and returns
+        the index of the worker.
+        """
+        worker = self.sessions.index(min(self.sessions))
+        self.sessions[worker] += 1
+        return worker
+
+    def max_inflight(self, worker):
+        """
+        Returns the number of frames of a session on the given worker that
+        may be processed at once.
+        """
+        return 1
+
+    def release(self, worker, session):
+        """ Unpins a closed session from its worker and drops its state. """
+        self.sessions[worker] -= 1
+        self.pools[worker].apply_async(_close, (session,))
+
+    def detect(self, worker, session, frame1, frame2, callback,
+               reply=IMAGE_REPLY):
+        """
+        Runs detection for the session on the given worker. Once the frames
+        are processed, callback(error, result) is invoked on the IOLoop thread.
+        reply selects what is encoded, see _detect.
+        """
+        ioloop = tornado.ioloop.IOLoop.instance()
+        def done(response):
+            ioloop.add_callback(lambda: callback(*response))
+        self.pools[worker].apply_async(_detect, (session, frame1, frame2, reply),
+                                       callback=done)
+
+    def close(self):
+        for pool in self.pools:
+            pool.terminate()
+
+class PipelinedSession(object):
+    """
+    Runs the pipeline of one session on a PipelinedExecutor, and hands the
+    results over to the IOLoop from a thread of its own, in order.
+    """
+
+    def __init__(self, kwargs):
+        self.executor = executor.PipelinedExecutor(pipeline.Pipeline.create(**kwargs))
+        self.requests = Queue.Queue()
+        self.thread = threading.Thread(target=self.collect)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, frame1, frame2, callback, reply):
+        self.requests.put((callback, reply))
+        self.executor.submit(frame1, frame2)
+
+    def collect(self):
+        ioloop = tornado.ioloop.IOLoop.instance()
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            callback, reply = request
+            try:
+                self.executor.result()
+                response = (None, _encode(self.executor.pipeline, reply))
+            except Exception:
+                response = (traceback.format_exc(), None)
+            ioloop.add_callback(lambda response=response: callback(*response))
+
+    def stop(self):
+        """
+        Tells the threads to stop once the frames in flight went through,
+        without waiting for them.
+        """
+        self.requests.put(None)
+        self.executor.stop()
+
+    def join(self):
+        """ Waits for the threads to stop. """
+        self.executor.join()
+        self.thread.join()
+
+    def close(self):
+        self.stop()
+        self.join()
+
+class PipelinedPool(object):
+    """
+    Runs the pipeline of every session on its own PipelinedExecutor, with
+    the same interface as WorkerPool. The stages of consecutive frames of a
+    session overlap, so a single session can use several cores.
+
+    Every PipelinedExecutor starts a thread per segment of stages, so only
+    the first nworkers sessions open at once get one. Sessions opened past
+    that run their frames one at a time on a shared thread instead.
+    """
+
+    def __init__(self, nworkers, inflight=3, **kwargs):
+        """
+        Constructor. nworkers is the max number of sessions with their own
+        PipelinedExecutor, inflight is the number of frames of a session
+        whose stages may overlap, and kwargs are passed to Pipeline.create.
+        """
+        cascade_names = [kwargs.get("face_cascade_name") or pipeline.FACE_CASCADE_NAME,
+                         kwargs.get("hand_cascade_name") or pipeline.HAND_CASCADE_NAME]
+        pipeline.CASCADES.preload(cascade_names)
+        self.nworkers = nworkers
+        self.inflight = inflight
+        self.kwargs = kwargs
+        self.slots = 0
+        self.sessions = {}
+
+        # Sessions past nworkers, and the thread waiting for the threads of
+        # closed sessions to stop, off the IOLoop
+        self.shared = WorkerPool(1, "thread", **kwargs)
+        self.closer = multiprocessing.pool.ThreadPool(1)
+
+    def assign(self):
+        """
+        Returns None if the new session gets its own PipelinedExecutor,
+        otherwise the index of its worker in the shared pool.
+        """
+        if self.slots < self.nworkers:
+            self.slots += 1
+            return None
+        return self.shared.assign()
+
+    def max_inflight(self, worker):
+        """
+        Returns inflight for the sessions with their own PipelinedExecutor,
+        and as for a WorkerPool for the sessions on the shared thread, so
+        they don't queue frames behind each other.
+        """
+        if worker is not None:
+            return self.shared.max_inflight(worker)
+        return self.inflight
+
+    def release(self, worker, session):
+        if worker is not None:
+            self.shared.release(worker, session)
+            return
+        self.slots -= 1
+        pipelined = self.sessions.pop(session, None)
+        if pipelined is not None:
+            pipelined.stop()
+            self.closer.apply_async(pipelined.join)
+
+    def detect(self, worker, session, frame1, frame2, callback,
+               reply=IMAGE_REPLY):
+        if worker is not None:
+            self.shared.detect(worker, session, frame1, frame2, callback, reply)
+            return
+        pipelined = self.sessions.get(session)
+        if pipelined is None:
+            pipelined = PipelinedSession(self.kwargs)
+            self.sessions[session] = pipelined
+        pipelined.submit(frame1, frame2, callback, reply)
+
+    def close(self):
+        for pipelined in self.sessions.values():
+            pipelined.stop()
+        for pipelined in self.sessions.values():
+            pipelined.join()
+        self.closer.close()
+        self.closer.join()
+        self.shared.close()
+
+class FrameScheduler(object):
+    """
+    Schedules the frames of one session on its worker, latest frame wins. At
+    most workers.max_inflight(worker) frames are in flight, and at most
+    max_pending frames wait behind them: when a frame arrives to a full
+    queue, the oldest waiting frame is dropped. Each frame is paired with
+    the frame scheduled just before it, so optical flow measures the motion
+    since the last processed frame, even when frames in between were
+    dropped. Once closed, no more frames are sent to the worker, so the
+    worker never sees the session again after release.
+    """
+
+    def __init__(self, workers, worker, session, callback, max_pending=1,
+                 reply=IMAGE_REPLY):
+        """
+        Constructor. callback(error, result) is invoked on the IOLoop thread
+        for every processed frame, and reply selects what is encoded.
+        """
+        self.workers = workers
+        self.worker = worker
+        self.session = session
+        self.callback = callback
+        self.max_pending = max_pending
+        self.reply = reply
+        self.pending = collections.deque()
+        self.prev = None
+        self.inflight = 0
+        self.closed = False
+
+        # Counters of frames queued, dropped while waiting, and processed
+        self.queued = 0
+        self.dropped = 0
+        self.processed = 0
+
+    def push(self, frame):
+        """ Queues a new frame, dropping the oldest frame if the queue is full. """
+        if self.closed:
+            return
+        if self.prev is None:
+            self.prev = frame
+            return
+        self.pending.append(frame)
+        self.queued += 1
+        if len(self.pending) > self.max_pending:
+            self.pending.popleft()
+            self.dropped += 1
+        self.schedule()
+
+    def schedule(self):
+        """ Sends the next waiting frame to the worker, if it has room. """
+        if (self.closed or
+            self.inflight >= self.workers.max_inflight(self.worker) or
+            not self.pending):
+            return
+        frame = self.pending.popleft()
+        self.inflight += 1
+        self.workers.detect(self.worker, self.session, self.prev, frame, self.done,
+                            self.reply)
+        self.prev = frame
+
+    def done(self, error, result):
+        self.inflight -= 1
+        self.processed += 1
+        self.callback(error, result)
+        self.schedule()
+
+    def close(self):
+        """
+        Drops the waiting frames, and stops sending frames to the worker, so
+        frames still in flight don't bring the session's state back.
+        """
+        self.closed = True
+        self.pending.clear()
+
+    def stats(self):
+        """ Returns the counters of this session. """
+        return {"queued": self.queued,
+                "dropped": self.dropped,
+                "processed": self.processed,
+                "pending": len(self.pending)}